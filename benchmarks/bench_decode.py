@@ -0,0 +1,78 @@
+"""
+LoadStreamsのデコード(backend='opencv'とbackend='ffmpeg')を、1フレームあたりの時間とCPU時間で比べる
+カメラの代わりに、ffmpegで作ったH.264の合成動画をできるだけ速く読む(CPU時間にはffmpegの子プロセスも含む)
+opencvは推論サイズへの縮小をPreprocessorで行うので、その分を足した値も出す
+
+Usage:
+    $ python benchmarks/bench_decode.py
+    $ python benchmarks/bench_decode.py --size 1920 1080 --n 300
+"""
+
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from common import measure, report
+
+from utils.augmentations import letterbox_geometry
+from utils.datasets import FfmpegCapture
+
+
+def make_video(path: Path, size: list, frames: int, fps: float) -> Path:
+    command = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+               '-i', f'testsrc2=size={size[0]}x{size[1]}:rate={fps}', '-frames:v', str(frames),
+               '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-g', str(int(fps) * 2), str(path)]
+    subprocess.run(command, check=True)
+    return path
+
+
+def reader(cap, resize_to: tuple = None):
+    # LoadStreams.updateと同じく、grabしてから確保済みのスロットにretrieveする
+    _, slot = cap.read()
+    resized = None if resize_to is None else np.empty((*resize_to[::-1], 3), dtype=np.uint8)
+
+    def read():
+        cap.grab()
+        success, im = cap.retrieve(image=slot)
+        assert success, 'end of video, increase the clip length'
+        if resized is not None:
+            cv2.resize(im, resize_to, dst=resized, interpolation=cv2.INTER_LINEAR)
+    return read
+
+
+def main(size: list, imgsz: list, fps: float, n: int, warmup: int) -> None:
+    _, _, new_unpad, _ = letterbox_geometry(size[::-1], imgsz, auto=False)
+    print(f'source {size[0]}x{size[1]} H.264, imgsz {imgsz} (resize to {new_unpad[0]}x{new_unpad[1]}), '
+          f'cv2 {cv2.__version__}, cv2 threads {cv2.getNumThreads()}')
+    with tempfile.TemporaryDirectory() as tmp:
+        source = str(make_video(Path(tmp) / 'source.mp4', size, n + warmup + 10, fps))
+
+        cap = cv2.VideoCapture(source)
+        report('opencv decode', measure(reader(cap), n=n, warmup=warmup))
+        cap.release()
+
+        cap = cv2.VideoCapture(source)
+        report('opencv decode + resize', measure(reader(cap, new_unpad), n=n, warmup=warmup))
+        cap.release()
+
+        cap = FfmpegCapture(source, img_size=imgsz, auto=False)
+        report('ffmpeg decode + scale/pad', measure(reader(cap), n=n, warmup=warmup))
+        cap.release()
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', nargs=2, type=int, default=[640, 360], help='source size w h (camera stream)')
+    parser.add_argument('--imgsz', nargs=2, type=int, default=[384, 640], help='inference size h w')
+    parser.add_argument('--fps', type=float, default=15, help='source fps')
+    parser.add_argument('--n', type=int, default=500, help='timed frames')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed frames first')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(**vars(parse_opt()))
@@ -0,0 +1,83 @@
+"""
+DetectMultiBackendの推論時間とCPU使用率を、PyTorch(.pt)とONNX Runtime(.onnx)で比べる
+ONNX Runtimeは、IO binding(DetectMultiBackendの既定)とsession.run(入出力を毎回確保)の両方を測る
+重みを指定しなければ、models/yolov5s.yamlから作ったモデル(重みはランダム)を書き出して測る(推論時間は重みの値によらない)
+
+Usage:
+    $ python benchmarks/bench_inference.py
+    $ python benchmarks/bench_inference.py --weights yolov5/yolov5s.pt yolov5/yolov5s.onnx --imgsz 384 640
+"""
+
+import os
+import argparse
+import tempfile
+from pathlib import Path
+
+import torch
+
+from common import ROOT, measure, report
+
+import export
+from models.common import DetectMultiBackend
+from models.yolo import Model
+
+
+def build_weights(save_dir: Path, cfg: Path = ROOT / 'yolov5/models/yolov5s.yaml') -> Path:
+    # cfgから作ったモデルを.ptに保存する
+    torch.manual_seed(0)
+    weights = save_dir / f'{cfg.stem}.pt'
+    model = Model(cfg).eval()
+    model.nc = model.yaml['nc']  # train.pyと同じく、export.runが読む属性を付けておく
+    torch.save({'model': model}, weights)
+    return weights
+
+
+def export_onnx(weights: Path, imgsz: list) -> Path:
+    # imgsz固定の.onnxに書き出す
+    export.run(weights=weights, imgsz=imgsz, include=['onnx'])
+    return weights.with_suffix('.onnx')
+
+
+def load(weights: Path, threads: int) -> DetectMultiBackend:
+    return DetectMultiBackend(weights, device=torch.device('cpu'), dnn=False, threads=threads)
+
+
+def bench(model: DetectMultiBackend, imgsz: list, n: int, warmup: int) -> dict:
+    im = torch.zeros(1, 3, *imgsz)
+    with torch.no_grad():
+        return measure(lambda: model(im), n=n, warmup=warmup)
+
+
+def main(weights: list, imgsz: list, threads: int, n: int, warmup: int) -> None:
+    threads = threads or max(1, os.cpu_count() - 2)  # detect.runのpipelinedと同じ
+    torch.set_num_threads(threads)
+    print(f'imgsz {imgsz}, threads {threads}, cpu_count {os.cpu_count()}, torch {torch.__version__}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not weights:
+            weights = [build_weights(Path(tmp))]
+            weights.append(export_onnx(weights[0], imgsz))
+        for w in weights:
+            model = load(w, threads)
+            size = list(model.fixed_shape[2:]) if model.fixed_shape is not None else imgsz
+            report(f'{Path(w).name} {size}', bench(model, size, n, warmup))
+            if model.onnx:
+                # IO bindingなしの比較用
+                im = torch.zeros(1, 3, *size).numpy()
+                result = measure(lambda: model.session.run([model.ort_output.name], {model.ort_input.name: im}),
+                                 n=n, warmup=warmup)
+                report(f'{Path(w).name} {size} session.run', result)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', nargs='+', type=Path, help='*.pt and/or *.onnx, default: yolov5s.yaml')
+    parser.add_argument('--imgsz', nargs=2, type=int, default=[384, 640], help='inference size h w')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 for cpu_count - 2')
+    parser.add_argument('--n', type=int, default=100, help='timed runs')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed runs first')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(**vars(parse_opt()))
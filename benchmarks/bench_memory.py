@@ -0,0 +1,102 @@
+"""
+合成した動画をLoadStreams(raw)→Preprocessor→Recorder(pre-roll付き)に流し続け、メモリが増え続けないことを確かめる
+録画の開始・停止を繰り返しながらRSSとtracemallocを測り、最初の録画以降の増加がしきい値を超えたら終了コード1で終わる
+
+Usage:
+    $ python benchmarks/bench_memory.py
+    $ python benchmarks/bench_memory.py --frames 20000 --max-growth-mb 16
+"""
+
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from common import rss_mb
+
+from camenashi_kun.recorder import PreRoll, Recorder
+from utils.augmentations import Preprocessor
+from utils.datasets import LoadStreams
+
+FOURCC = cv2.VideoWriter_fourcc(*'MJPG')
+
+
+def make_video(path: Path, size: tuple, frames: int, fps: float) -> Path:
+    # フレームごとに中身を変えて、重複フレームとして読み飛ばされないようにする
+    writer = cv2.VideoWriter(str(path), FOURCC, fps, size)
+    for i in range(frames):
+        frame = np.full((size[1], size[0], 3), i % 256, dtype=np.uint8)
+        cv2.putText(frame, str(i), (10, size[1] // 2), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def main(frames: int, size: list, fps: float, imgsz: list, record_every: int, record_frames: int,
+         max_growth_mb: float) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        # LoadStreamsは取りに来なかったフレームを読み飛ばすので、ソースは長めに作ってframes枚で打ち切る
+        source = make_video(tmp / 'source.avi', tuple(size), frames * 2, fps)
+        # 既存のファイルパスはstreams.txtとして読まれるので、ソースの一覧に書いて渡す
+        (tmp / 'streams.txt').write_text(f'{source}\n')
+        dataset = LoadStreams(str(tmp / 'streams.txt'), img_size=imgsz, stride=32, auto=False, raw=True)
+        dataset.quit_key = False  # ウィンドウは出さない
+        preprocess = Preprocessor(imgsz, stride=32)
+        recorder = Recorder(pre_roll=PreRoll(seconds=2, max_bytes=16 * 2**20))
+
+        tracemalloc.start()
+        samples = []  # (フレーム番号, RSS MB, tracemalloc MB)
+        baseline = None  # 最初の録画が終わった時点(バッファが出そろった後)
+        start, n, recordings = time.perf_counter(), 0, 0
+        for _, ims, im0s, _, _ in dataset:
+            if n == frames:
+                break
+            preprocess(ims)
+            recorder.write(im0s[0])
+            n += 1
+            if n % record_every == 0 and not recorder.is_recording:
+                recorder.start(tmp / f'rec{recordings}.avi', FOURCC, fps, im0s[0].shape[1::-1])
+            elif n % record_every == record_frames and recorder.is_recording:
+                path = tmp / f'rec{recordings}.avi'
+                recorder.stop(callback=lambda p: p.unlink(missing_ok=True)).wait(10)
+                recordings += 1
+                samples.append((n, rss_mb(), tracemalloc.get_traced_memory()[0] / 2**20))
+                if baseline is None:
+                    baseline = samples[-1]
+                print(f'frame {n:6d}  recordings {recordings:4d}  RSS {samples[-1][1]:7.1f} MB  '
+                      f'traced {samples[-1][2]:6.1f} MB  ({path.name})', flush=True)
+        elapsed = time.perf_counter() - start
+        recorder.close()
+        tracemalloc.stop()
+
+    print(f'{n} frames in {elapsed:.1f}s ({n / elapsed:.1f} FPS), {recordings} recordings, '
+          f'{dataset.duplicates} duplicate waits')
+    if len(samples) < 2:
+        print('Not enough recordings to compare, increase --frames')
+        return 1
+    rss_growth, traced_growth = samples[-1][1] - baseline[1], samples[-1][2] - baseline[2]
+    print(f'Growth after the first recording: RSS {rss_growth:+.1f} MB, traced {traced_growth:+.1f} MB '
+          f'(limit {max_growth_mb} MB)')
+    return 0 if max(rss_growth, traced_growth) <= max_growth_mb else 1
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=6000, help='frames to replay through the pipeline')
+    parser.add_argument('--size', nargs=2, type=int, default=[640, 360], help='synthetic frame size w h')
+    parser.add_argument('--fps', type=float, default=90, help='synthetic fps (LoadStreams sleeps 1/fps per frame)')
+    parser.add_argument('--imgsz', nargs=2, type=int, default=[384, 640], help='inference size h w')
+    parser.add_argument('--record-every', type=int, default=300, help='start a recording every N frames')
+    parser.add_argument('--record-frames', type=int, default=150, help='frames per recording')
+    parser.add_argument('--max-growth-mb', type=float, default=16, help='allowed growth after the first recording')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(**vars(parse_opt())))
@@ -0,0 +1,85 @@
+"""
+録画の経路ごとに、1本の録画にかかるCPU時間と、録画停止からアップロードできるファイルができるまでの時間を比べる
+    opencv: Recorder(cv2.VideoWriter)で書き出してから、Ffmpeg.compressでFFMPEG_OPTIONSに圧縮する
+    ffmpeg: Recorder(FfmpegWriter)で、録画しながらFFMPEG_OPTIONSでエンコードする
+フレームはffmpegで作った合成動画を先にメモリへ読み込んでおき、カメラと同じくfpsの間隔で流し込む(CPU時間にはffmpegの子プロセスも含む)
+
+Usage:
+    $ python benchmarks/bench_recorder.py
+    $ python benchmarks/bench_recorder.py --size 1280 720 --frames 300 --ffmpeg-options=-c:v,libx264,-b:v,800k
+"""
+
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from common import cpu_seconds
+
+from camenashi_kun import env
+from camenashi_kun.ffmpeg import Ffmpeg
+from camenashi_kun.recorder import Recorder
+
+
+def load_frames(size: list, frames: int, fps: float) -> list[np.ndarray]:
+    # testsrc2を生のBGRで受け取る(エンコードとデコードのCPUを測定に含めないように、先に全部読む)
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+               '-i', f'testsrc2=size={size[0]}x{size[1]}:rate={fps}', '-frames:v', str(frames),
+               '-pix_fmt', 'bgr24', '-f', 'rawvideo', 'pipe:1']
+    raw = subprocess.run(command, check=True, capture_output=True).stdout
+    return list(np.frombuffer(raw, dtype=np.uint8).reshape(-1, size[1], size[0], 3))
+
+
+def record(encoder: str, frames: list, fourcc: int, fps: float, options: list, video_file_path: Path) -> dict:
+    recorder = Recorder(maxsize=len(frames), policy='block', encoder=encoder, ffmpeg_options=options)
+    size = frames[0].shape[1::-1]
+    cpu, start = cpu_seconds(), time.perf_counter()
+    recorder.start(video_file_path, fourcc, fps, size)
+    for i, frame in enumerate(frames):
+        time.sleep(max(start + i / fps - time.perf_counter(), 0))
+        recorder.write(frame)
+    stopped, cpu_recording = time.perf_counter(), cpu_seconds() - cpu
+    recorder.stop().wait()
+    if not recorder.is_encoded:
+        video_file_path = Ffmpeg().compress(video_file_path, options)
+    ready = time.perf_counter()
+    cpu = cpu_seconds() - cpu
+    recorder.close()
+    return {'cpu': cpu, 'cpu_ms': cpu / len(frames) * 1000, 'cpu_recording': cpu_recording / (stopped - start) * 100,
+            'stop_to_ready': ready - stopped, 'written': recorder.written, 'mb': video_file_path.stat().st_size / 10**6}
+
+
+def main(size: list, frames: int, fps: float, fourcc: str, ffmpeg_options: list, encoders: list) -> None:
+    options = ffmpeg_options or env.FFMPEG_OPTIONS
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        # カメラと同じfourccが使えなければ(OpenCVのビルドによる)、mp4vで代用する
+        if not cv2.VideoWriter(str(tmp / 'probe.mp4'), cv2.VideoWriter_fourcc(*fourcc), fps, tuple(size)).isOpened():
+            print(f'fourcc {fourcc} is not available in this OpenCV build, using mp4v')
+            fourcc = 'mp4v'
+        print(f'{frames} frames {size[0]}x{size[1]} at {fps:g} FPS, fourcc {fourcc}, FFMPEG_OPTIONS {options}')
+        images = load_frames(size, frames, fps)
+        for encoder in encoders:
+            result = record(encoder, images, cv2.VideoWriter_fourcc(*fourcc), fps, options, tmp / f'{encoder}.mp4')
+            print(f'{encoder:<8} CPU {result["cpu"]:6.2f} s ({result["cpu_ms"]:.2f} ms/frame)  '
+                  f'while recording {result["cpu_recording"]:5.1f}%  stop -> ready {result["stop_to_ready"]:6.2f} s  '
+                  f'{result["written"]} frames, {result["mb"]:.2f} MB', flush=True)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', nargs=2, type=int, default=[640, 360], help='recorded frame size w h')
+    parser.add_argument('--frames', type=int, default=300, help='frames per recording')
+    parser.add_argument('--fps', type=float, default=15, help='recording fps')
+    parser.add_argument('--fourcc', default='avc1', help='cv2.VideoWriter fourcc (core.py uses avc1)')
+    parser.add_argument('--ffmpeg-options', type=lambda x: x.split(','), help='default: FFMPEG_OPTIONS')
+    parser.add_argument('--encoders', nargs='+', default=['opencv', 'ffmpeg'], help='RECORDER_ENCODER to compare')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(**vars(parse_opt()))
@@ -0,0 +1,85 @@
+"""
+ROI推論(ROI_MARGIN)と映像全体の推論を、1フレームあたりの前処理+推論の時間とCPU使用率で比べる(1フレームずつ交互に測る)
+LoadStreamsと同じ計算で検知エリア+余白を切り出して推論サイズを縮め、Preprocessor→DetectMultiBackendを通す
+入力shape固定のモデル(--dynamicなしの.onnx)はROIでもサイズが変わらないので、既定では.ptで測る
+
+Usage:
+    $ python benchmarks/bench_roi.py
+    $ python benchmarks/bench_roi.py --weights yolov5/yolov5s.pt --areas 0,0,480,384 160,90,480,270 --margin 32
+"""
+
+import os
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from common import measure_interleaved, report
+from bench_inference import build_weights, load
+
+from utils.augmentations import Preprocessor
+from utils.general import make_divisible
+
+
+def roi_size(area: list, margin: int, frame_size: list, imgsz: list, stride: int) -> tuple:
+    # LoadStreamsのROIと同じ計算。(切り出すスライス, 推論サイズ)
+    w0, h0 = frame_size
+    x1, y1 = max(0, area[0] - margin), max(0, area[1] - margin)
+    x2, y2 = min(w0, area[2] + margin), min(h0, area[3] + margin)
+    img_size = [min(make_divisible(y2 - y1, stride), imgsz[0]), min(make_divisible(x2 - x1, stride), imgsz[1])]
+    return (slice(y1, y2), slice(x1, x2)), img_size
+
+
+def step(model, preprocess: Preprocessor, im: np.ndarray):
+    # 1フレーム分の前処理と推論
+    def run():
+        with torch.no_grad():
+            model(preprocess([im]))
+    return run
+
+
+def main(weights: Path, size: list, imgsz: list, areas: list, margin: int, threads: int, n: int, warmup: int) -> None:
+    threads = threads or max(1, os.cpu_count() - 2)
+    torch.set_num_threads(threads)
+    print(f'frame {size[0]}x{size[1]}, imgsz {imgsz}, margin {margin}, threads {threads}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model = load(weights or build_weights(Path(tmp)), threads)
+        assert model.fixed_shape is None, f'{weights} accepts only {list(model.fixed_shape[2:])}, ROI cannot shrink it'
+        frame = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+
+        steps = {}
+        for area in [None, *areas]:
+            if area is None:
+                roi, img_size, name = (slice(None), slice(None)), imgsz, 'full frame'
+            else:
+                roi, img_size = roi_size(area, margin, size, imgsz, model.stride)
+                name = f'ROI {",".join(map(str, area))}'
+            im = frame[roi]
+            preprocess = Preprocessor(img_size, stride=model.stride, auto=model.pt and not model.jit)
+            preprocess([im])
+            shape = tuple(preprocess.inputs[0].shape[2:])
+            steps[f'{name} {im.shape[1]}x{im.shape[0]} -> {shape[1]}x{shape[0]}'] = step(model, preprocess, im)
+
+        for name, result in measure_interleaved(steps, n=n, warmup=warmup).items():
+            report(name, result)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=Path, help='*.pt or dynamic *.onnx, default: yolov5s.yaml')
+    parser.add_argument('--size', nargs=2, type=int, default=[640, 360], help='camera frame size w h')
+    parser.add_argument('--imgsz', nargs=2, type=int, default=[384, 640], help='inference size h w')
+    parser.add_argument('--areas', nargs='+', type=lambda x: [int(i) for i in x.split(',')],
+                        default=[[0, 0, 480, 384], [160, 90, 480, 270]], help='DETECT_AREA x1,y1,x2,y2 to compare')
+    parser.add_argument('--margin', type=int, default=32, help='ROI_MARGIN')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 for cpu_count - 2')
+    parser.add_argument('--n', type=int, default=100, help='timed frames')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed frames first')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(**vars(parse_opt()))
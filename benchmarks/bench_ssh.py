@@ -0,0 +1,171 @@
+"""
+Sshのアップロードを、接続を張ったまま使い回す場合と、アップロードのたびに接続し直す場合で比べる
+NASの代わりに、このプロセス内でparamikoのSSH/SFTPサーバーを127.0.0.1に立てる(ローカルのファイルシステムに書き、
+sha256sumなどのexecはローカルのシェルで実行する)。~/.ssh/configは一時ディレクトリのものを使う
+1回ずつ交互にアップロードして、1回あたりの時間とCPU使用率(サーバー側のスレッドも含む)を出す
+
+Usage:
+    $ python benchmarks/bench_ssh.py
+    $ python benchmarks/bench_ssh.py --n 50 --size-mb 4
+"""
+
+import os
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+import paramiko
+
+from common import measure_interleaved, report
+
+
+class LocalHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class LocalSFTP(paramiko.SFTPServerInterface):
+    # ローカルのファイルシステムをそのまま見せる
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = LocalHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def _call(self, fn, *args):
+        try:
+            result = fn(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK if result is None else result
+
+    def stat(self, path):
+        return self._call(lambda: paramiko.SFTPAttributes.from_stat(os.stat(path)))
+
+    def lstat(self, path):
+        return self._call(lambda: paramiko.SFTPAttributes.from_stat(os.lstat(path)))
+
+    def list_folder(self, path):
+        return self._call(lambda: [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                                   for name in os.listdir(path)])
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, oldpath, newpath)
+
+
+class StandIn(paramiko.ServerInterface):
+    # client_keyの公開鍵認証だけを受け付ける
+    def __init__(self, client_key: paramiko.PKey) -> None:
+        self.client_key = client_key
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL if key == self.client_key else paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            result = subprocess.run(command.decode(), shell=True, capture_output=True)
+            channel.sendall(result.stdout)
+            channel.sendall_stderr(result.stderr)
+            channel.send_exit_status(result.returncode)
+            channel.close()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+
+def serve(host_key: paramiko.PKey, client_key: paramiko.PKey) -> int:
+    # 接続ごとにTransportを立てる。待ち受けたポート番号を返す
+    logging.getLogger('bench_ssh.server').setLevel(logging.CRITICAL)
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def accept():
+        while True:
+            sock, _ = listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # sshdと同じく小さなパケットを溜めない
+            transport = paramiko.Transport(sock)
+            transport.set_log_channel('bench_ssh.server')  # 切断時のエラーログはクライアント側と混ぜない
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTP)
+            transport.start_server(server=StandIn(client_key))
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def main(n: int, warmup: int, size_mb: float) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        client_key = paramiko.RSAKey.generate(2048)
+        key_path = tmp / 'id_rsa'
+        client_key.write_private_key_file(str(key_path))
+        port = serve(paramiko.RSAKey.generate(2048), client_key)
+
+        # load_ssh_configは~/.ssh/configを読むので、HOMEごと差し替える(Sshを作る前に)
+        os.environ['HOME'] = str(tmp)
+        (tmp / '.ssh').mkdir()
+        (tmp / '.ssh' / 'config').write_text(
+            f'Host bench-nas\n    HostName 127.0.0.1\n    Port {port}\n    User bench\n    IdentityFile {key_path}\n'
+        )
+        from camenashi_kun.ssh import Ssh
+
+        local = tmp / 'clip.mp4'
+        local.write_bytes(os.urandom(int(size_mb * 10**6)))
+        (tmp / 'nas').mkdir()
+        print(f'{size_mb:g} MB per upload to 127.0.0.1:{port}, paramiko {paramiko.__version__}')
+
+        persistent = Ssh('bench-nas')
+
+        def upload_persistent():
+            assert persistent.sftp_upload(str(local), str(tmp / 'nas' / 'persistent.mp4'))
+
+        def upload_reconnect():
+            ssh = Ssh('bench-nas')
+            try:
+                assert ssh.sftp_upload(str(local), str(tmp / 'nas' / 'reconnect.mp4'))
+            finally:
+                ssh.close()
+
+        results = measure_interleaved({'persistent connection': upload_persistent,
+                                       'reconnect per upload': upload_reconnect}, n=n, warmup=warmup)
+        for name, result in results.items():
+            report(name, result)
+        persistent.close()
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=30, help='timed uploads per mode')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed uploads first')
+    parser.add_argument('--size-mb', type=float, default=2, help='upload size (MB)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(**vars(parse_opt()))
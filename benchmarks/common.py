@@ -0,0 +1,88 @@
+"""
+ベンチマークの共通処理
+経過時間はp50/p95(ms)、CPU使用率はこのプロセスと子プロセス(ffmpegなど)の合計(1コア=100%)と1回あたりのCPU時間(ms)で出す
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import psutil
+
+ROOT = Path(__file__).resolve().parents[1]
+for path in (ROOT, ROOT / 'yolov5'):
+    if str(path) not in sys.path:
+        sys.path.append(str(path))
+
+# camenashi_kunをimportするとEnvが読み込まれるので、.envがなくても必須の値だけは入れておく
+for key, value in {
+    'FFMPEG_OPTIONS': '-vcodec,libx264',
+    'MOVIE_SPEED': '1',
+    'NOTICE_THRESHOLD': '3',
+    'THRESHOLD_NO_DETECTED_SECONDS': '10',
+    'DETECT_AREA': '0,0,640,384',
+    'PAUSE_SECONDS': '5',
+    'BLACK_SCREEN_SECONDS': '60',
+    'THRESHOLD_STORAGE_DAYS': '30',
+}.items():
+    os.environ.setdefault(key, value)
+
+
+def cpu_seconds() -> float:
+    # このプロセスと子プロセスが使ったCPU時間の合計(終了した子プロセスはwaitした時点で加算される)
+    process = psutil.Process()
+    times = process.cpu_times()
+    total = times.user + times.system + times.children_user + times.children_system
+    for child in process.children(recursive=True):
+        try:
+            child_times = child.cpu_times()
+            total += child_times.user + child_times.system
+        except psutil.Error:
+            pass
+    return total
+
+
+def rss_mb() -> float:
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def summarize(times: list, cpu: float, wall: float) -> dict:
+    # times: 1回ごとの経過時間(秒), cpu: その間のCPU時間(秒), wall: 全体の経過時間(秒)
+    ms = np.asarray(times) * 1000
+    return {'n': len(ms), 'p50': np.percentile(ms, 50), 'p95': np.percentile(ms, 95), 'mean': ms.mean(),
+            'cpu': cpu / wall * 100 if wall > 0 else 0.0, 'cpu_ms': cpu / len(ms) * 1000}
+
+
+def measure(fn, n: int = 100, warmup: int = 10) -> dict:
+    # fn()をwarmup回空回ししてから、n回の経過時間と全体のCPU使用率を測る
+    for _ in range(warmup):
+        fn()
+    times = []
+    cpu, start = cpu_seconds(), time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return summarize(times, cpu_seconds() - cpu, time.perf_counter() - start)
+
+
+def measure_interleaved(fns: dict, n: int = 100, warmup: int = 10) -> dict:
+    # {名前: fn}を1回ずつ順番に回して測る(負荷やクロックの変動が、どれかに偏らないように)
+    for _ in range(warmup):
+        for fn in fns.values():
+            fn()
+    times, cpu = {name: [] for name in fns}, dict.fromkeys(fns, 0.0)
+    for _ in range(n):
+        for name, fn in fns.items():
+            c, t = cpu_seconds(), time.perf_counter()
+            fn()
+            times[name].append(time.perf_counter() - t)
+            cpu[name] += cpu_seconds() - c
+    return {name: summarize(times[name], cpu[name], sum(times[name])) for name in fns}
+
+
+def report(name: str, result: dict) -> None:
+    print(f'{name:<40} n={result["n"]:<5} p50 {result["p50"]:8.2f} ms  p95 {result["p95"]:8.2f} ms  '
+          f'mean {result["mean"]:8.2f} ms  CPU {result["cpu"]:6.1f}% ({result["cpu_ms"]:.2f} ms/run)', flush=True)
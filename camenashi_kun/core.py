@@ -1,23 +1,30 @@
 import time
 import datetime
 import signal
+import threading
 from logging import getLogger
 from pathlib import Path
-from statistics import mean
+from collections import deque
 
 import cv2
 import numpy as np
 from ping3 import ping
 
 from camenashi_kun import env
-from camenashi_kun.ffmpeg import Ffmpeg
-from camenashi_kun.ssh import Ssh
+from camenashi_kun.ffmpeg import Segmenter
 from camenashi_kun.discord import Discord
+from camenashi_kun.jobs import JobStore
+from camenashi_kun.pipeline import Pipeline
+from camenashi_kun.ssh import Manifest
+from camenashi_kun.recorder import PreRoll, Recorder, SegmentRecorder
+from camenashi_kun.stream import RecordStream
+from camenashi_kun.motion import MotionGate
+from camenashi_kun.scheduler import InferenceScheduler
 import yolov5.detect as detect
 
 
 logger = getLogger(__name__)
-disco = Discord(env.DISCORD_WEBHOOK_URL)
+disco = Discord(env.DISCORD_WEBHOOK_URL, env.DISCORD_MAX_FILES, int(env.DISCORD_MAX_UPLOAD_MB * 1024 * 1024))
 
 
 class TerminatedExecption(Exception):
@@ -28,6 +35,10 @@ def raise_exception(*_):
     raise TerminatedExecption()
 
 
+def rtsp_url(stream: str) -> str:
+    return f'rtsp://{env.CAMERA_USER}:{env.CAMERA_PASS}@{env.CAMERA_IP}:554/{stream}'
+
+
 def ping_to_target(target_ip: str) -> bool:
     RETRY_COUNT = 3
     for i in range(RETRY_COUNT):
@@ -69,8 +80,35 @@ def main(no_view=False) -> None:
         detected_count = 0  # 検知回数
         video_dir = Path.joinpath(Path(__file__).resolve().parent, 'videos')  # 録画映像保存用ディレクトリ
         video_file_path = Path()  # 録画映像ファイル
-        video_writer = None  # opencvのvideo writer
-        fps_list = []  # 録画映像のFPS
+        if env.RECORDER_ENCODER == 'copy':
+            # カメラのH.264をそのままセグメントに保存しておき、録画はそこから切り出す
+            segmenter = Segmenter(
+                rtsp_url(env.RECORD_STREAM if env.IS_DUAL_STREAM else env.DETECT_STREAM),
+                Path.joinpath(Path(__file__).resolve().parent, 'segments'),
+                keep_seconds=env.PRE_ROLL_SECONDS + 60,
+            )
+            recorder = SegmentRecorder(segmenter, env.PRE_ROLL_SECONDS, env.MOVIE_SPEED, env.FFMPEG_OPTIONS)
+            record_stream = None
+        else:
+            # 録画は別スレッドで書き出す。検知回数の閾値に達する前の数秒もpre-rollで残しておく
+            pre_roll = PreRoll(env.PRE_ROLL_SECONDS, env.PRE_ROLL_MAX_MB * 10**6) if env.PRE_ROLL_SECONDS > 0 else None
+            recorder = Recorder(
+                maxsize=env.RECORDER_QUEUE_SIZE,
+                policy=env.RECORDER_POLICY,
+                pre_roll=pre_roll,
+                encoder=env.RECORDER_ENCODER,
+                ffmpeg_options=env.FFMPEG_OPTIONS,
+            )
+            # デュアルストリームなら、録画は高解像度のメインストリームから取る
+            record_stream = RecordStream(rtsp_url(env.RECORD_STREAM), recorder) if env.IS_DUAL_STREAM else None
+        is_recording = False  # 録画中かどうかフラグ
+        # 録画後の処理。状態はSQLiteに残して、再起動しても続きから処理する
+        job_store = JobStore(Path.joinpath(Path(__file__).resolve().parent, 'jobs.db'))
+        # NASにアップロードしたファイルの一覧
+        manifest = Manifest(Path.joinpath(Path(__file__).resolve().parent, 'manifest.db'))
+        pipeline = Pipeline(disco, video_dir, job_store, manifest)
+        # 録画されるのは検知ループに届いたフレーム(推論をスキップしたものも含む)なので、届いた時刻からFPSを出す
+        frame_times = deque(maxlen=150)
         no_detected_start = 0  # 非検知秒数のカウント用
         no_detected_elapsed_time = 0  # 非検知経過時間
         view_img = not no_view  # ストリーミング表示するかは、引数から受け取る
@@ -78,15 +116,32 @@ def main(no_view=False) -> None:
         black_screen_start = 0  # 真っ黒画面になった時間
         black_screen_elapsed_seconds = 0  # 真っ黒画面の経過時間
         is_notified_screen_all_black = False  # 映像が真っ暗になったことを通知したかフラグ
+        # 検知エリアに動きがないフレームは推論しない
+        motion_gate = MotionGate(
+            env.DETECT_AREA,
+            method=env.MOTION_METHOD,
+            threshold=env.MOTION_THRESHOLD,
+            keepalive_seconds=env.MOTION_KEEPALIVE_SECONDS,
+        ) if env.IS_MOTION_GATE else None
+        # 待機中は推論レートを落とす。動きがあれば全フレーム推論する
+        scheduler = InferenceScheduler(env.IDLE_FPS, motion_gate) if env.IDLE_FPS > 0 else None
 
         try:
             for label_list, frame, fps, log_str in detect.run(
-                weights='yolov5/yolov5s.pt',
+                weights=env.WEIGHTS,
                 imgsz=[384, 640],
-                source=f'rtsp://{env.CAMERA_USER}:{env.CAMERA_PASS}@{env.CAMERA_IP}:554/stream2',
+                source=rtsp_url(env.DETECT_STREAM),
                 nosave=True,
                 view_img=view_img,
-                detect_area=env.DETECT_AREA
+                detect_area=env.DETECT_AREA,
+                backend=env.CAPTURE_BACKEND,
+                gate=motion_gate if scheduler is None else scheduler,
+                roi_margin=env.ROI_MARGIN,
+                threads=env.INFERENCE_THREADS,
+                keep_classes=[env.DETECT_LABEL] if env.IS_PRUNE_CLASSES else None,
+                channels_last=env.IS_CHANNELS_LAST,
+                pipelined=env.IS_PIPELINED,
+                queue_size=env.PIPELINE_QUEUE_SIZE,
             ):
                 # ループの最初で解像度を取得しておく
                 if is_first_loop:
@@ -94,20 +149,30 @@ def main(no_view=False) -> None:
                     logger.info(f'frame_width: {frame_width}, frame_height: {frame_height}')
                     is_first_loop = False
 
-                # video_writerオブジェクトがNoneじゃなければ(動体検知したら)、録画する
-                if video_writer is not None:
-                    video_writer.write(frame)
+                # 録画中なら(動体検知したら)、録画する。録画中でなければrecorderは何もしない
+                if record_stream is None:
+                    recorder.write(frame)
+                frame_times.append(time.perf_counter())
+
+                # 検知中(非検知の猶予秒数を含む)は、全フレーム推論する
+                if scheduler is not None:
+                    scheduler.set_active(detected_count > 0)
+
+                # 推論をスキップしたフレームは、録画だけして次へ
+                if label_list is None:
+                    continue
 
                 # 検知対象リストにあるか判定
                 if env.DETECT_LABEL in label_list:
                     detected_count += 1
                     # 非検知タイマーリセット
                     no_detected_start = 0
-                    # 録画時に指定する用に、FPSをlistに入れておく
-                    fps_list.append(fps)
+                    # 録画開始時に最初のフレームを取りこぼさないよう、先に録画用ストリームに接続しておく
+                    if record_stream is not None:
+                        record_stream.open()
 
                     # 映像書き出し中以外は、ログ文言に検知回数を追記
-                    if video_writer is None:
+                    if not is_recording:
                         log_str += f'Detected count: {detected_count}'
                         logger.info(log_str)
                 elif no_detected_start == 0:
@@ -123,64 +188,28 @@ def main(no_view=False) -> None:
                     if no_detected_elapsed_time > env.THRESHOLD_NO_DETECTED_SECONDS:
                         logger.info(f'No detected for {env.THRESHOLD_NO_DETECTED_SECONDS} seconds.')
 
-                        if video_writer is None:
-                            # video_writerオブジェクトがNoneの場合は、検知回数閾値に達さずに非検知になったとき
+                        if not is_recording:
+                            # 録画していない場合は、検知回数閾値に達さずに非検知になったとき
                             # （一瞬だけトイレに入って、すぐ出た場合を想定）
                             pass
                         else:
-                            # 録画終了
-                            video_writer.release()
+                            # 録画終了。書き出しが終わったら、後処理(圧縮・アップロード・通知・削除)は裏で行う
+                            callback = lambda path: pipeline.submit(path, recorder.is_encoded)
+                            if record_stream is None:
+                                recorder.stop(callback=callback)
+                            elif not record_stream.stop_rec(callback=callback):
+                                # メインストリームにつながらないまま終わったことを、検知を止めずに知らせる
+                                threading.Thread(target=disco.post, args=(
+                                    f'{env.DETECT_LABEL}を動体検知しましたが、録画用のストリームにつながらず録画できませんでした。',
+                                ), daemon=True).start()
                             logger.info('○○○ Finish Rec ○○○')
                             logger.info('=== Reset detected count. ===')
 
-                            # 圧縮
-                            ffmpeg = Ffmpeg()
-                            video_file_path = ffmpeg.compress(video_file_path, env.FFMPEG_OPTIONS)
-
-                            # SFTPでアップロード
-                            ssh = Ssh(env.SSH_HOSTNAME)
-                            logger.info(f'SSH to {env.SSH_HOSTNAME}({ssh.config["hostname"]})')
-                            # NASに動画をSFTPでアップロード
-                            sftp_upload_result = ssh.sftp_upload(
-                                str(video_file_path),
-                                str(Path(env.SSH_UPLOAD_DIR).joinpath(video_file_path.name)),
-                            )
-
-                            # アップロードが成功したら古いファイルは削除
-                            if sftp_upload_result:
-                                ssh.remove_old_files(env.SSH_UPLOAD_DIR, env.THRESHOLD_STORAGE_DAYS)
-
-                            # Discordに通知できた映像は削除する
-                            # 以前POSTに失敗したファイルもvideosディレクトリに残っているはずなので
-                            # ここで順番にPOSTする
-                            removed_videos = []
-                            sorted_videos = sorted(video_dir.iterdir(), key=lambda x: x.name)
-                            for video in sorted_videos:
-                                uploaded_file_path = f'//{ssh.config["hostname"]}{Path(env.SSH_UPLOAD_DIR).joinpath(video.name)}'
-                                post_result, post_message = disco.post(
-                                    f'{env.DETECT_LABEL}を動体検知しました\n{uploaded_file_path}',
-                                    [video],
-                                    mention_id=env.MENTION_ID,
-                                )
-
-                                if post_result:
-                                    removed_videos.append(str(video))
-                                    # 削除
-                                    Path(video).unlink()
-                                    # 動画が複数あれば、次のPOSTまでちょっと待機
-                                    if len(sorted_videos) > 1:
-                                        time.sleep(3)
-                                else:
-                                    disco.post(
-                                        f'動画のPOSTに失敗しました。\n{post_message}\n'
-                                    )
-                                    # POSTに失敗したら、以降のファイルは次回に持ち越し
-                                    break
-                            logger.info(f'Delete videos: {removed_videos}')
-
                         logger.info('=== Restart detecting ===')
                         # 初期化
-                        video_writer = None
+                        if record_stream is not None:
+                            record_stream.close()
+                        is_recording = False
                         detected_count = 0
                         no_detected_start = 0
                         no_detected_elapsed_time = 0
@@ -210,10 +239,18 @@ def main(no_view=False) -> None:
 
                     # 動画書き出し
                     video_file_path = Path(video_dir).joinpath(f'{file_name}.{video_suffix}')
-                    # FPSは平均を取って、何倍速か計算
-                    rec_fps = round(mean(fps_list), 0) * env.MOVIE_SPEED
+                    # 直近のフレームの間隔の平均からFPSを出して、何倍速か計算
+                    elapsed = frame_times[-1] - frame_times[0]
+                    rec_fps = round((len(frame_times) - 1) / elapsed if elapsed > 0 else 15.0, 0) * env.MOVIE_SPEED
 
-                    video_writer = cv2.VideoWriter(str(video_file_path), fourcc, rec_fps, (frame_width, frame_height))
+                    if record_stream is None:
+                        recorder.start(video_file_path, fourcc, rec_fps, (frame_width, frame_height))
+                        is_recording = True
+                    else:
+                        # メインストリームはカメラのFPSで届くので、それを基準に何倍速か決める
+                        # つながっていなければ、つながったときに録画が始まる
+                        record_stream.start_rec(video_file_path, fourcc, env.MOVIE_SPEED)
+                        is_recording = True
                     logger.info('●●● Start Rec ●●●')
 
                     continue
@@ -280,6 +317,14 @@ def main(no_view=False) -> None:
             logger.info(f'*** Restart {env.APP_NAME} ***')
             # systemdで再起動
             raise e
+        finally:
+            if record_stream is not None:
+                record_stream.close(timeout=5)
+            recorder.close()
+            # ワーカーが止まってからDBを閉じる(止まらなければ、プロセスの終了に任せる)
+            if pipeline.close():
+                job_store.close()
+                manifest.close()
     else:
         logger.error(f'[{env.CAMERA_IP}] is NOT responding. Please check device.')
 
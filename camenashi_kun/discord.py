@@ -1,7 +1,12 @@
+import json
+import time
+import uuid
+import threading
 from pathlib import Path
 from logging import getLogger
 import random
 import requests
+from requests.adapters import HTTPAdapter
 
 from camenashi_kun import env
 
@@ -9,10 +14,158 @@ from camenashi_kun import env
 logger = getLogger(__name__)
 
 
+# 絵文字のAPIもローカルの一覧も使えないとき用
+FALLBACK_EMOJIS = ['🐢', '🐸', '🐱', '🐶', '🐰', '🐻', '🐼', '🐧', '🐤', '🦊', '🐙', '🦀', '🌸', '🌻', '🍀', '⭐', '🌙', '🍙', '🍡', '🎈']
+
+
+class EmojiCache:
+    '''
+    絵文字の一覧をファイルに保存しておき、そこからランダムに選ぶ
+    ttl_secondsを過ぎていたら、バックグラウンドでAPIから取り直す(通知はそれを待たない)
+    '''
+    def __init__(self, url: str, cache_path: Path, ttl_seconds: float = 86400, timeout: tuple = (6, 12),
+                 retry_seconds: float = 600) -> None:
+        self.url = url
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds  # 取得に失敗したら、この秒数は取り直さない
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.fetched_at, self.emojis = self._load()
+
+    def _load(self) -> tuple[float, list]:
+        # ファイル → ローカルの一覧(emoji.emojis_local) → 組み込みの一覧の順に使う
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache['emojis']:
+                logger.info(f'Loaded {len(cache["emojis"])} emojis from {self.cache_path}')
+                return cache['fetched_at'], cache['emojis']
+        except Exception as e:
+            logger.info(f'No emoji cache: {e}')
+        try:
+            from emoji import emojis_local
+            return 0.0, list(emojis_local)
+        except ImportError:
+            return 0.0, list(FALLBACK_EMOJIS)
+
+    def _refresh(self) -> None:
+        logger.info(f'Starting fetch emojis from {self.url}')
+        try:
+            response = requests.get(self.url, timeout=self.timeout)
+            response.encoding = response.apparent_encoding
+            emojis = [emoji for emoji in response.json() if isinstance(emoji, str) and emoji]
+            if not emojis:
+                raise ValueError('Empty emoji list.')
+            with self.lock:
+                self.fetched_at, self.emojis = time.time(), emojis
+            # 書きかけのファイルを読まないように、書き終えてから置き換える
+            tmp_path = self.cache_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': self.fetched_at, 'emojis': emojis}, f, ensure_ascii=False)
+            tmp_path.replace(self.cache_path)
+            logger.info(f'Fetched {len(emojis)} emojis.')
+        except Exception as e:
+            logger.error(f'Failed to fetch emojis: {e} (retry in {self.retry_seconds:.0f}s)')
+            # APIが落ちている間、POSTのたびに取りに行かないようにする(手元の一覧はそのまま使う)
+            with self.lock:
+                self.fetched_at = time.time() - self.ttl_seconds + self.retry_seconds
+        finally:
+            self.refreshing = False
+
+    def sample(self, number: int) -> list:
+        with self.lock:
+            if self.url and not self.refreshing and time.time() - self.fetched_at > self.ttl_seconds:
+                self.refreshing = True
+                threading.Thread(target=self._refresh, daemon=True).start()
+            emojis = self.emojis
+        if len(emojis) < number:
+            return random.choices(emojis, k=number)
+        return random.sample(emojis, number)
+
+
+class MultipartBody:
+    '''
+    multipart/form-dataのボディを、ファイルを読み込みながら少しずつ返す
+    requestsは__len__でContent-Lengthを決めて、readで読んだ分から送るので、ファイル全体をメモリに載せない
+    '''
+    def __init__(self, fields: dict, files: list[Path]) -> None:
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self.parts = []  # bytesかPath
+        for name, value in fields.items():
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        for i, file in enumerate(files):
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="files[{i}]"; filename="{file.name}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n'.encode()
+            )
+            self.parts.append(file)
+            self.parts.append(b'\r\n')
+        self.parts.append(f'--{self.boundary}--\r\n'.encode())
+        self.length = sum(len(part) if isinstance(part, bytes) else part.stat().st_size for part in self.parts)
+        self.sent = 0
+        self.current = None  # 読み込み中のファイル
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.length
+        chunks = []
+        while size > 0 and (self.parts or self.current is not None):
+            if self.current is None:
+                part = self.parts.pop(0)
+                if isinstance(part, bytes):
+                    chunk = part[:size]
+                    if len(part) > size:
+                        self.parts.insert(0, part[size:])
+                    chunks.append(chunk)
+                    size -= len(chunk)
+                    continue
+                self.current = open(str(part), 'rb')
+            chunk = self.current.read(size)
+            if not chunk:
+                self.close()
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b''.join(chunks)
+        self.sent += len(data)
+        return data
+
+    def close(self) -> None:
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
 class Discord:
-    def __init__(self, url: str) -> None:
+    '''
+    レスポンスのX-RateLimit-*とRetry-Afterを見て、制限にかからないように送信を待つ
+    '''
+    def __init__(self, url: str, max_files: int = 10, max_upload_bytes: int = 10 * 1024 * 1024,
+                 retries: int = 3) -> None:
         self.webhook_url = url
         self.timeout = (6, 12)
+        self.max_files = max_files  # 1メッセージに添付できるファイル数
+        self.max_upload_bytes = max_upload_bytes  # 1メッセージに添付できる合計サイズ
+        self.retries = retries  # 429が返ってきたときに待って送り直す回数
+        self.rate_limit_lock = threading.Lock()
+        self.next_send_at = 0.0  # この時刻までは送らない
+        # Webhookのホストとの接続は使い回す
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.emoji_cache = EmojiCache(
+            env.EMOJI_API_URL,
+            Path.joinpath(Path(__file__).resolve().parent, 'emojis.json'),
+            env.EMOJI_CACHE_HOURS * 3600,
+            self.timeout,
+        )
 
     def post(self, content: str, files: list[Path] = [], mention_id=None) -> tuple[bool, str]:
         '''
@@ -28,57 +181,95 @@ class Discord:
         }
 
         error = ''
-        multiple_files = []
+        # 録画に失敗したファイルなどは、添付せずに本文だけ送る
+        missing = [file for file in files if not Path(file).is_file()]
+        if missing:
+            logger.warning(f'Skip missing files: {missing}')
+            files = [file for file in files if file not in missing]
         if len(files):
             logger.info(f'Post files: {files}.')
-            for file in files:
-                file_name = file.name
-                with open(str(file), 'rb') as f:
-                    file_binary = f.read()
-                multiple_files.append(
-                    (file_name, (file_name, file_binary))
-                )
 
-        try:
-            logger.info('Starting Discord webhook post.')
-            response = requests.post(
-                self.webhook_url,
-                data=data,
-                files=multiple_files,
-                timeout=self.timeout,
-            )
+        for attempt in range(self.retries + 1):
+            self._wait_rate_limit()
+            body = None
+            try:
+                body = MultipartBody(data, files)
+                logger.info('Starting Discord webhook post.')
+                start = time.perf_counter()
+                response = self.session.post(
+                    self.webhook_url,
+                    data=body,
+                    headers={'Content-Type': body.content_type},
+                    timeout=self.timeout,
+                )
+                elapsed = time.perf_counter() - start
+                logger.info(f'Sent {len(body) / 10**6:.2f} MB in {elapsed:.2f}s ({len(body) / 10**6 / max(elapsed, 1e-6):.2f} MB/s)')
+                self._update_rate_limit(response)
 
-            logger.info(f'Received status code: {response.status_code}')
-            if 200 <= response.status_code < 300:
-                logger.info('Discord webhook post successful.')
-                return True, response.text
-            else:
+                logger.info(f'Received status code: {response.status_code}')
+                if 200 <= response.status_code < 300:
+                    logger.info('Discord webhook post successful.')
+                    return True, response.text
                 error = f'Failed to post: {response.status_code}, {response.text}'
                 logger.warning(error)
-        except requests.exceptions.Timeout:
-            error = 'Request timed out.'
-            logger.error(error)
-        except requests.exceptions.ConnectionError as ce:
-            error = f'Connection error: {ce}'
-            logger.error(error)
-        except Exception as e:
-            error = f'Unexpected error: {e}'
-            logger.error(error)
+                if response.status_code != 429:
+                    break
+            except requests.exceptions.Timeout:
+                error = 'Request timed out.'
+                logger.error(error)
+                break
+            except requests.exceptions.ConnectionError as ce:
+                error = f'Connection error: {ce}'
+                logger.error(error)
+                break
+            except Exception as e:
+                error = f'Unexpected error: {e}'
+                logger.error(error)
+                break
+            finally:
+                if body is not None:
+                    body.close()
 
         return False, error
 
-    def _choice_emoji(self, number: int) -> list:
-        logger.info(f'Starting fetch emojis from {env.EMOJI_API_URL}')
-        try:
-            response = requests.get(env.EMOJI_API_URL, timeout=self.timeout)
-            response.encoding = response.apparent_encoding
-            emojis = response.json()
-        except Exception as e:
-            logger.critical(e)
-            from emoji import emojis_local
-            emojis = emojis_local
+    def _wait_rate_limit(self) -> None:
+        with self.rate_limit_lock:
+            wait = self.next_send_at - time.monotonic()
+        if wait > 0:
+            logger.info(f'Waiting {wait:.2f}s for Discord rate limit.')
+            time.sleep(wait)
+
+    def _update_rate_limit(self, response: requests.Response) -> None:
+        # https://discord.com/developers/docs/topics/rate-limits
+        wait = 0.0
+        if response.status_code == 429:
+            try:
+                wait = float(response.headers.get('Retry-After') or response.json()['retry_after'])
+            except Exception:
+                wait = 1.0
+        elif response.headers.get('X-RateLimit-Remaining') == '0':
+            # 残り回数を使い切ったら、リセットされるまで待つ
+            wait = float(response.headers.get('X-RateLimit-Reset-After', 1.0))
+        if wait > 0:
+            with self.rate_limit_lock:
+                self.next_send_at = max(self.next_send_at, time.monotonic() + wait)
 
+    def pack(self, files: list[Path]) -> list[list[Path]]:
+        # 添付できる数とサイズに収まるように、先頭から順にまとめる(1つで上限を超えるファイルは単独で送る)
+        batches, batch, batch_bytes = [], [], 0
+        for file in files:
+            size = file.stat().st_size if file.exists() else 0
+            if batch and (len(batch) >= self.max_files or batch_bytes + size > self.max_upload_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(file)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _choice_emoji(self, number: int) -> list:
         # 指定した数分の絵文字をランダムに取得
-        choices = random.sample(emojis, number)
+        choices = self.emoji_cache.sample(number)
         logger.info(f'Choiced emojis: {choices}')
         return choices
@@ -15,6 +15,14 @@ class Env:
         self.CAMERA_IP = os.getenv('CAMERA_IP')
         self.CAMERA_USER = os.getenv('CAMERA_USER')
         self.CAMERA_PASS = os.getenv('CAMERA_PASS')
+        self.DETECT_STREAM = os.getenv('DETECT_STREAM', 'stream2')
+        self.RECORD_STREAM = os.getenv('RECORD_STREAM', 'stream1')
+        self.IS_DUAL_STREAM = True if os.getenv('IS_DUAL_STREAM') == 'True' else False
+        self.RECORDER_QUEUE_SIZE = int(os.getenv('RECORDER_QUEUE_SIZE', 300))
+        self.RECORDER_POLICY = os.getenv('RECORDER_POLICY', 'drop')
+        self.RECORDER_ENCODER = os.getenv('RECORDER_ENCODER', 'opencv')
+        self.PRE_ROLL_SECONDS = float(os.getenv('PRE_ROLL_SECONDS', 0))
+        self.PRE_ROLL_MAX_MB = int(os.getenv('PRE_ROLL_MAX_MB', 64))
         self.FFMPEG_OPTIONS = os.getenv('FFMPEG_OPTIONS').split(',')
 
         self.MOVIE_SPEED = int(os.getenv('MOVIE_SPEED'))
@@ -22,15 +30,33 @@ class Env:
         self.THRESHOLD_NO_DETECTED_SECONDS = int(os.getenv('THRESHOLD_NO_DETECTED_SECONDS'))
         self.DETECT_LABEL = os.getenv('DETECT_LABEL')
         self.DETECT_AREA = [int(i) for i in os.getenv('DETECT_AREA').split(',')]
+        self.ROI_MARGIN = int(os.getenv('ROI_MARGIN')) if os.getenv('ROI_MARGIN') else None
         self.PAUSE_SECONDS = int(os.getenv('PAUSE_SECONDS'))
         self.BLACK_SCREEN_SECONDS = int(os.getenv('BLACK_SCREEN_SECONDS'))
+        self.CAPTURE_BACKEND = os.getenv('CAPTURE_BACKEND', 'opencv')
+        self.WEIGHTS = os.getenv('WEIGHTS', 'yolov5/yolov5s.pt')
+        self.INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', 0))
+        self.IS_PRUNE_CLASSES = True if os.getenv('IS_PRUNE_CLASSES') == 'True' else False
+        self.IS_CHANNELS_LAST = True if os.getenv('IS_CHANNELS_LAST') == 'True' else False
+        self.IS_PIPELINED = True if os.getenv('IS_PIPELINED') == 'True' else False
+        self.PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 1))
+        self.IS_MOTION_GATE = True if os.getenv('IS_MOTION_GATE') == 'True' else False
+        self.MOTION_METHOD = os.getenv('MOTION_METHOD', 'diff')
+        self.MOTION_THRESHOLD = float(os.getenv('MOTION_THRESHOLD', 0.01))
+        self.MOTION_KEEPALIVE_SECONDS = float(os.getenv('MOTION_KEEPALIVE_SECONDS', 5))
+        self.IDLE_FPS = float(os.getenv('IDLE_FPS', 0))
 
         self.SSH_HOSTNAME = os.getenv('SSH_HOSTNAME')
         self.SSH_UPLOAD_DIR = os.getenv('SSH_UPLOAD_DIR')
         self.THRESHOLD_STORAGE_DAYS = int(os.getenv('THRESHOLD_STORAGE_DAYS'))
+        self.SWEEP_INTERVAL_SECONDS = float(os.getenv('SWEEP_INTERVAL_SECONDS', 3600))
+        self.MANIFEST_RECONCILE_SECONDS = float(os.getenv('MANIFEST_RECONCILE_SECONDS', 86400))
 
         self.DISCORD_WEBHOOK_URL = os.getenv('DISCORD_WEBHOOK_URL')
+        self.DISCORD_MAX_FILES = int(os.getenv('DISCORD_MAX_FILES', 10))
+        self.DISCORD_MAX_UPLOAD_MB = float(os.getenv('DISCORD_MAX_UPLOAD_MB', 10))
         self.EMOJI_API_URL = os.getenv('EMOJI_API_URL')
+        self.EMOJI_CACHE_HOURS = float(os.getenv('EMOJI_CACHE_HOURS', 24))
         self.MENTION_ID = os.getenv('MENTION_ID')
 
     def update_value(self, key: str, after) -> tuple[str, object]:
@@ -1,7 +1,12 @@
+import time
+import threading
 import subprocess
+from datetime import datetime
 from pathlib import Path
 from logging import getLogger
 
+import numpy as np
+
 
 logger = getLogger(__name__)
 
@@ -12,11 +17,19 @@ class Ffmpeg:
 
     def compress(self, video_file_path: Path, options: list) -> Path:
         compressed_file_path = Path(video_file_path.parent).joinpath(f'{video_file_path.stem}_compressed{video_file_path.suffix}')
+        if not video_file_path.exists() and compressed_file_path.exists():
+            # 圧縮が終わって元のファイルを消した直後に落ちていた(元のファイルは圧縮が成功したときしか消さない)
+            logger.info(f'Already compressed: {compressed_file_path}')
+            return compressed_file_path
         try:
-            # ffmpeg -i {video_file_path} {options} {compressed_file_path}
-            command = ['ffmpeg', '-i', str(video_file_path), *options, str(compressed_file_path)]
+            # 前回途中で落ちたときの書きかけのファイルは消しておく
+            compressed_file_path.unlink(missing_ok=True)
+            # ffmpeg -y -i {video_file_path} {options} {compressed_file_path}
+            command = ['ffmpeg', '-y', '-i', str(video_file_path), *options, str(compressed_file_path)]
             logger.info(f'ffmpeg command: {" ".join(command)}')
-            subprocess.run(command)
+            result = subprocess.run(command, stdin=subprocess.DEVNULL)
+            if result.returncode != 0:
+                raise RuntimeError(f'ffmpeg exited with code {result.returncode}')
 
             # 圧縮前後のファイルサイズ
             size_before = video_file_path.stat().st_size / self.mega
@@ -29,5 +42,153 @@ class Ffmpeg:
 
             return compressed_file_path
         except Exception as e:
+            # 元のファイルは残して、そのまま使う
             logger.error(f'Compression failed: {e}')
+            compressed_file_path.unlink(missing_ok=True)
             return video_file_path
+
+
+class FfmpegWriter:
+    '''
+    cv2.VideoWriter互換のライタ
+    フレームをrawvideoでffmpegの標準入力に流し込み、FFMPEG_OPTIONSで直接エンコードする
+    録画終了と同時に圧縮済みのファイルができるので、compressが不要になる
+    '''
+    def __init__(self, video_file_path: Path, fps: float, size: tuple, options: list) -> None:
+        self.video_file_path = video_file_path
+        command = [
+            'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{size[0]}x{size[1]}', '-r', str(fps), '-i', 'pipe:0',
+            *options, str(video_file_path),
+        ]
+        logger.info(f'ffmpeg command: {" ".join(command)}')
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.is_broken = False
+
+    def isOpened(self) -> bool:
+        return self.proc.poll() is None
+
+    def write(self, frame: np.ndarray) -> None:
+        if self.is_broken:
+            return
+        try:
+            self.proc.stdin.write(memoryview(np.ascontiguousarray(frame)))
+        except BrokenPipeError:
+            # ffmpegが落ちたら、以降のフレームは捨てる
+            self.is_broken = True
+            logger.error(f'ffmpeg encoder exited with code {self.proc.poll()}')
+
+    def release(self) -> bool:
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = self.proc.wait()
+        if return_code != 0:
+            logger.error(f'ffmpeg encoder failed: return code {return_code}')
+        return return_code == 0
+
+
+class Segmenter:
+    '''
+    カメラのH.264をデコードせずに(-c copy)、短いセグメントファイルに分けて保存し続ける
+    録画はセグメントをつなぎ合わせて作るので、エンコードのCPUがほとんどかからない
+    '''
+    TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+    def __init__(self, url: str, segment_dir: Path, segment_seconds: int = 2, keep_seconds: float = 120) -> None:
+        self.url = url
+        self.segment_dir = segment_dir
+        self.segment_seconds = segment_seconds
+        self.keep_seconds = keep_seconds  # 録画していないときに残しておく秒数
+        self.hold_from = None  # 録画中はこの時刻以降のセグメントを消さない
+        self.is_running = False
+        self.thread = None
+
+    def start(self) -> None:
+        if self.is_running:
+            return
+        self.segment_dir.mkdir(parents=True, exist_ok=True)
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.is_running = False
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+
+    def _run(self) -> None:
+        input_options = ['-rtsp_transport', 'tcp'] if self.url.lower().startswith('rtsp://') else []
+        command = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error', *input_options, '-i', self.url,
+            '-map', '0:v', '-c', 'copy', '-f', 'segment', '-segment_time', str(self.segment_seconds),
+            '-reset_timestamps', '1', '-strftime', '1', str(self.segment_dir.joinpath(f'{self.TIME_FORMAT}.ts')),
+        ]
+        while self.is_running:
+            logger.info('Start segmenter.')
+            proc = subprocess.Popen(command, stdin=subprocess.DEVNULL)
+            while self.is_running and proc.poll() is None:
+                time.sleep(self.segment_seconds)
+                self.prune()
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+            elif self.is_running:
+                # 切断されたらちょっと待ってから再接続
+                logger.warning(f'Segmenter exited with code {proc.returncode}. Restarting.')
+                time.sleep(5)
+
+    def segments(self) -> list[tuple[datetime, Path]]:
+        segments = []
+        for path in self.segment_dir.glob('*.ts'):
+            try:
+                segments.append((datetime.strptime(path.stem, self.TIME_FORMAT), path))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def prune(self) -> None:
+        # 保存期間を過ぎたセグメントを削除(最新のセグメントは書き込み中なので残す)
+        threshold = datetime.now().timestamp() - self.keep_seconds
+        if self.hold_from is not None:
+            threshold = min(threshold, self.hold_from.timestamp())
+        for started_at, path in self.segments()[:-1]:
+            if started_at.timestamp() < threshold:
+                path.unlink(missing_ok=True)
+
+    def cut(self, start: datetime, end: datetime, video_file_path: Path, speed: int = 1, options: list = None) -> bool:
+        '''
+        startからendまでを含むセグメントをつなぎ合わせて動画にする
+        セグメントはキーフレームで始まるので、先頭はstart直前のキーフレームになる
+        speedが1より大きければ、optionsでエンコードし直して早送りにする
+        '''
+        # endを含むセグメントが書き終わるまで待つ
+        deadline = time.monotonic() + self.segment_seconds * 5
+        while not any(started_at > end for started_at, _ in self.segments()) and time.monotonic() < deadline:
+            time.sleep(self.segment_seconds / 2)
+
+        segments = self.segments()
+        selected = [
+            path for i, (started_at, path) in enumerate(segments)
+            if started_at <= end and (i + 1 == len(segments) or segments[i + 1][0] > start)
+        ]
+        if not selected:
+            logger.error(f'No segments found between {start} and {end}.')
+            return False
+
+        concat_list = video_file_path.with_suffix('.txt')
+        concat_list.write_text(''.join(f"file '{path.resolve()}'\n" for path in selected))
+        if speed > 1:
+            encode_options = ['-vf', f'setpts=PTS/{speed}', *(options or [])]
+        else:
+            encode_options = ['-c', 'copy']
+        command = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                   '-i', str(concat_list), '-an', *encode_options, str(video_file_path)]
+        logger.info(f'ffmpeg command: {" ".join(command)}')
+        try:
+            result = subprocess.run(command)
+        finally:
+            concat_list.unlink(missing_ok=True)
+        logger.info(f'Cut {len(selected)} segments into {video_file_path.name}')
+        return result.returncode == 0
@@ -0,0 +1,135 @@
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class JobStore:
+    '''
+    録画後の処理の状態を、録画ごとにSQLite(WALモード)に保存する
+    どのステージまで終わったかを残しておくので、再起動しても途中から再開できる
+    status: queued(キューに入っている/処理中), failed(リトライ待ち), done(完了)
+    アップロードと通知は、アップロードに失敗したら通知を先にするので、どちらが終わったかをフラグで持つ
+    '''
+    STAGES = ('compress', 'upload', 'notify', 'cleanup')
+    FLAGS = {'upload': 'uploaded', 'notify': 'notified'}  # 順番が入れ替わりうるステージの完了フラグ
+
+    def __init__(self, db_path: Path, backoff_seconds: float = 30, max_backoff_seconds: float = 3600) -> None:
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    clip TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    is_encoded INTEGER NOT NULL DEFAULT 0,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_retry_at REAL NOT NULL DEFAULT 0,
+                    hostname TEXT NOT NULL DEFAULT '',
+                    uploaded INTEGER NOT NULL DEFAULT 0,
+                    notified INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_status_retry ON jobs (status, next_retry_at);
+                CREATE INDEX IF NOT EXISTS idx_jobs_stage ON jobs (stage, status);
+            ''')
+            columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(jobs)')}
+            if 'uploaded' not in columns:
+                # 完了フラグがないDBは、ステージの順番どおりに進んでいる
+                self.connection.execute('ALTER TABLE jobs ADD COLUMN uploaded INTEGER NOT NULL DEFAULT 0')
+                self.connection.execute('ALTER TABLE jobs ADD COLUMN notified INTEGER NOT NULL DEFAULT 0')
+                self.connection.execute("UPDATE jobs SET uploaded = 1 WHERE stage IN ('notify', 'cleanup', 'done')")
+                self.connection.execute("UPDATE jobs SET notified = 1 WHERE stage IN ('cleanup', 'done')")
+
+    def add(self, video_file_path: Path, is_encoded: bool = False, stage: str = 'compress') -> str:
+        now = time.time()
+        clip = video_file_path.stem
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO jobs (clip, path, is_encoded, stage, status, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (clip, str(video_file_path), int(is_encoded), stage, 'queued', now, now),
+            )
+        return clip
+
+    def get(self, clip: str) -> sqlite3.Row:
+        with self.lock:
+            return self.connection.execute('SELECT * FROM jobs WHERE clip = ?', (clip,)).fetchone()
+
+    def update(self, clip: str, **values) -> None:
+        values['updated_at'] = time.time()
+        columns = ', '.join(f'{key} = ?' for key in values)
+        with self.lock:
+            self.connection.execute(f'UPDATE jobs SET {columns} WHERE clip = ?', (*values.values(), clip))
+
+    def advance(self, clip: str, **values) -> str:
+        # 次のステージへ。最後のステージが終わったらdone
+        # 後回しにしたステージ(通知の後のアップロード)に戻るときは、すぐには再開せずにリトライ待ちにする
+        job = self.get(clip)
+        stage = job['stage']
+        if stage in self.FLAGS:
+            values[self.FLAGS[stage]] = 1
+        done = {name: values.get(flag, job[flag]) for name, flag in self.FLAGS.items()}
+        remaining = [name for name in self.STAGES[1:] if name != stage and not done.get(name)]
+        next_retry_at = 0
+        if not remaining:
+            next_stage, status = 'done', 'done'
+        elif self.STAGES.index(remaining[0]) < self.STAGES.index(stage):
+            next_stage, status, next_retry_at = remaining[0], 'failed', time.time() + self.backoff_seconds
+        else:
+            next_stage, status = remaining[0], 'queued'
+        self.update(clip, stage=next_stage, status=status, attempts=0, next_retry_at=next_retry_at, error=None,
+                    **values)
+        return next_stage
+
+    def defer(self, clip: str, stage: str, error: str) -> None:
+        # 失敗したステージを後回しにして、先にstageを処理する(失敗したステージはadvanceで戻ってくる)
+        self.update(clip, stage=stage, status='failed', attempts=0, next_retry_at=0, error=error)
+
+    def fail(self, clip: str, error: str) -> float:
+        # 失敗したステージは、待ち時間を倍々に伸ばしながらリトライする
+        attempts = self.get(clip)['attempts'] + 1
+        delay = min(self.backoff_seconds * 2 ** (attempts - 1), self.max_backoff_seconds)
+        self.update(clip, status='failed', attempts=attempts, next_retry_at=time.time() + delay, error=error)
+        return delay
+
+    def due(self, limit: int = 100) -> list[sqlite3.Row]:
+        # リトライ時刻を過ぎた失敗ジョブ(インデックスで引くので、溜まっているジョブ数にしか依存しない)
+        with self.lock:
+            return self.connection.execute(
+                "SELECT * FROM jobs WHERE status = 'failed' AND next_retry_at <= ? ORDER BY next_retry_at LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+
+    def failed(self, stage: str, max_attempts: int = 3, limit: int = 100) -> list[sqlite3.Row]:
+        # stageのリトライ時刻を過ぎたジョブ(失敗を繰り返しているジョブは、他のジョブの道連れにしないよう除く)
+        with self.lock:
+            return self.connection.execute(
+                "SELECT * FROM jobs WHERE stage = ? AND status = 'failed' AND next_retry_at <= ? AND attempts < ? "
+                "ORDER BY created_at LIMIT ?",
+                (stage, time.time(), max_attempts, limit),
+            ).fetchall()
+
+    def recover(self) -> list[sqlite3.Row]:
+        # 前回の起動時にキューに入っていたジョブ(落ちたときに処理中だったもの)
+        with self.lock:
+            return self.connection.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at"
+            ).fetchall()
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,83 @@
+import time
+from logging import getLogger
+
+import cv2
+import numpy as np
+
+
+logger = getLogger(__name__)
+
+
+class MotionGate:
+    '''
+    検知エリアを縮小したグレースケール画像で動きを判定して、YOLOで推論するフレームを絞る
+    動きがなくても、keepalive_seconds毎に1回は推論する（じっとしているねこちゃんを見逃さないため）
+    '''
+    def __init__(self, detect_area: list, method: str = 'diff', threshold: float = 0.01,
+                 keepalive_seconds: float = 5.0, width: int = 160, report_seconds: float = 600) -> None:
+        self.detect_area = detect_area
+        self.method = method
+        self.threshold = threshold  # 変化したピクセルの割合がこれを超えたら動きありとする
+        self.keepalive_seconds = keepalive_seconds
+        self.width = width  # 判定用に縮小する幅
+        self.report_seconds = report_seconds
+        self.backgrounds = {}  # ストリームごとの背景(diffは平均画像、mog2/knnは背景差分器)
+
+        self.gated = 0  # 推論をスキップしたフレーム数
+        self.inferred = 0  # 推論したフレーム数
+        self.last_inferred = 0.0
+        self.last_report = time.perf_counter()
+
+    def _preprocess(self, frame: np.ndarray) -> np.ndarray:
+        x1, y1, x2, y2 = self.detect_area
+        crop = frame[y1:y2, x1:x2]
+        height = max(1, round(crop.shape[0] * self.width / crop.shape[1]))
+        small = cv2.resize(crop, (self.width, height), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+    def _background(self, index: int, gray: np.ndarray):
+        if index not in self.backgrounds:
+            if self.method == 'mog2':
+                self.backgrounds[index] = cv2.createBackgroundSubtractorMOG2(detectShadows=False)
+            elif self.method == 'knn':
+                self.backgrounds[index] = cv2.createBackgroundSubtractorKNN(detectShadows=False)
+            else:
+                self.backgrounds[index] = gray.astype(np.float32)
+        return self.backgrounds[index]
+
+    def has_motion(self, frame: np.ndarray, index: int = 0) -> bool:
+        gray = self._preprocess(frame)
+        background = self._background(index, gray)
+
+        if self.method in ('mog2', 'knn'):
+            mask = background.apply(gray)
+        else:
+            # 移動平均の背景とのフレーム差分
+            diff = cv2.absdiff(gray, cv2.convertScaleAbs(background))
+            cv2.accumulateWeighted(gray, background, 0.05)
+            _, mask = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
+
+        return cv2.countNonZero(mask) / mask.size > self.threshold
+
+    def __call__(self, frames: list) -> bool:
+        now = time.perf_counter()
+        # 背景を更新するため、全ストリームで判定する
+        motion = [self.has_motion(frame, i) for i, frame in enumerate(frames)]
+        if any(motion) or now - self.last_inferred > self.keepalive_seconds:
+            self.inferred += 1
+            self.last_inferred = now
+            result = True
+        else:
+            self.gated += 1
+            result = False
+
+        if now - self.last_report > self.report_seconds:
+            self.report()
+            self.last_report = now
+        return result
+
+    def report(self) -> None:
+        total = self.gated + self.inferred
+        rate = self.gated / total if total else 0
+        logger.info(f'Motion gate: inferred {self.inferred}, gated {self.gated} ({rate:.1%} of frames skipped)')
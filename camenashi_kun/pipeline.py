@@ -0,0 +1,267 @@
+import time
+import queue
+import threading
+from pathlib import Path
+from logging import getLogger
+
+from camenashi_kun import env
+from camenashi_kun.ffmpeg import Ffmpeg
+from camenashi_kun.ssh import Manifest, Ssh
+from camenashi_kun.discord import Discord
+from camenashi_kun.jobs import JobStore
+
+
+logger = getLogger(__name__)
+
+
+class Pipeline:
+    '''
+    録画後の処理(圧縮 → アップロード → 通知 → 削除)を、ステージごとのスレッドとキューで処理する
+    検知ループは録画を投げるだけで、すぐに検知に戻れる
+    キューには上限があり、下流が詰まっていれば上流は空くまで待つ
+    各ステージの結果はJobStoreに残し、失敗したステージだけをリトライする
+    NASに上げられなくても通知は止めない(アップロードは通知の後にリトライする)
+    '''
+    def __init__(self, disco: Discord, video_dir: Path, store: JobStore, manifest: Manifest = None,
+                 maxsize: int = 8, retry_interval: float = 5) -> None:
+        self.disco = disco
+        self.video_dir = video_dir
+        self.store = store
+        self.manifest = manifest
+        self.retry_interval = retry_interval
+        self.stages = {
+            'compress': self._compress,
+            'upload': self._upload,
+            'notify': self._notify,
+            'cleanup': self._cleanup,
+        }
+        self.queues = {name: queue.Queue(maxsize) for name in self.stages}
+        self.callbacks = []  # 全ステージが終わったら呼ぶ callback(clip)
+        self.latency = {}  # ジョブごと・ステージごとの処理時間(秒)
+        self.is_running = True
+        self._ssh = None
+        self.ssh_lock = threading.Lock()
+
+        self._import_videos()
+        # 前回の起動時に処理中だったジョブは、止まったステージから再開する
+        self.pending = self.store.recover()
+
+        self.threads = [
+            threading.Thread(target=self._worker, args=(name,), name=f'pipeline-{name}', daemon=True)
+            for name in self.stages
+        ]
+        self.threads.append(threading.Thread(target=self._retry_loop, name='pipeline-retry', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def _import_videos(self) -> None:
+        # JobStoreを使う前から残っている動画を取り込む(起動時の1回だけ)
+        if not self.video_dir.is_dir():
+            return
+        for video in sorted(self.video_dir.glob('*.mp4')):
+            if self.store.get(video.stem) is None and self.store.get(video.stem.removesuffix('_compressed')) is None:
+                is_encoded = video.stem.endswith('_compressed')
+                self.store.add(video, is_encoded, stage='upload' if is_encoded else 'compress')
+                logger.info(f'Imported leftover video: {video.name}')
+
+    @property
+    def ssh(self) -> Ssh:
+        # 接続はアップロードと削除で使い回す(~/.ssh/configが読めなければ、そのステージが失敗してリトライされる)
+        with self.ssh_lock:
+            if self._ssh is None:
+                self._ssh = Ssh(env.SSH_HOSTNAME, manifest=self.manifest,
+                                reconcile_seconds=env.MANIFEST_RECONCILE_SECONDS)
+            return self._ssh
+
+    def add_callback(self, callback) -> None:
+        self.callbacks.append(callback)
+
+    def submit(self, video_file_path: Path, is_encoded: bool = False, timeout: float = None) -> str:
+        # 最初のキューが一杯なら空くまで待つ(timeoutを過ぎたらqueue.Fullを投げる)
+        clip = self.store.add(video_file_path, is_encoded)
+        self.latency[clip] = {}
+        self.queues['compress'].put(clip, timeout=timeout)
+        logger.info(f'Submitted {clip} (queue depth: {[q.qsize() for q in self.queues.values()]})')
+        return clip
+
+    def close(self, timeout: float = 10) -> bool:
+        '''
+        ワーカーが止まったらTrue(止まるまでは、JobStoreやManifestを閉じてはいけない)
+        キューに残ったジョブはqueuedのままJobStoreに残り、次回の起動時に再開する
+        '''
+        self.is_running = False
+        for q in self.queues.values():
+            try:
+                q.put(None, timeout=1)
+            except queue.Full:
+                pass  # ワーカーは今のジョブを終えたら、is_runningを見て止まる
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(timeout=max(deadline - time.monotonic(), 0))
+        is_stopped = not any(thread.is_alive() for thread in self.threads)
+        if not is_stopped:
+            logger.warning(f'Pipeline workers did not stop within {timeout} seconds.')
+        if self._ssh is not None:
+            self._ssh.close()
+        return is_stopped
+
+    def _enqueue(self, job) -> bool:
+        # 先にqueuedにしておかないと、ワーカーが処理し終えた後に上書きしてしまう
+        self.store.update(job['clip'], status='queued')
+        try:
+            self.queues[job['stage']].put_nowait(job['clip'])
+        except queue.Full:
+            self.store.update(job['clip'], status=job['status'])
+            return False
+        return True
+
+    def _retry_loop(self) -> None:
+        while self.is_running:
+            # 再起動前に処理中だったジョブと、リトライ時刻を過ぎたジョブをキューに戻す
+            self.pending = [job for job in self.pending if not self._enqueue(job)]
+            for job in self.store.due():
+                if not self._enqueue(job):
+                    break
+            time.sleep(self.retry_interval)
+
+    def _drain(self, name: str, limit: int) -> list[str]:
+        # キューに溜まっているジョブを、待たずにlimit個まで取り出す
+        clips = []
+        while len(clips) < limit:
+            try:
+                clip = self.queues[name].get_nowait()
+            except queue.Empty:
+                break
+            if clip is None:
+                # 終了の合図は戻しておく
+                self.queues[name].put(None)
+                break
+            clips.append(clip)
+        return clips
+
+    def _worker(self, name: str) -> None:
+        process = self.stages[name]
+        while True:
+            clip = self.queues[name].get()
+            if clip is None or not self.is_running:
+                break
+
+            clips = [clip]
+            if name == 'notify':
+                # 溜まっている通知と、リトライ時刻を過ぎた通知を、まとめて送る
+                # 障害から復旧したら、溜まった分が数回のPOSTで出ていく
+                clips += self._drain(name, self.disco.max_files - 1)
+                for job in self.store.failed(name, limit=self.disco.max_files * 4):
+                    if job['clip'] not in clips:
+                        self.store.update(job['clip'], status='queued')
+                        clips.append(job['clip'])
+            # リトライのループからも同じジョブがキューに入ることがあるので、ステージが進んだものは除く
+            jobs = [job for job in (self.store.get(clip) for clip in clips) if job is not None and job['stage'] == name]
+            clips = [job['clip'] for job in jobs]
+            if not jobs:
+                continue
+
+            start = time.perf_counter()
+            try:
+                results = process(jobs) if name == 'notify' else [process(jobs[0])]
+                errors = ['' if result else f'{name} failed' for result in results]
+            except Exception as e:
+                results, errors = [False] * len(jobs), [str(e)] * len(jobs)
+            elapsed = time.perf_counter() - start
+
+            for clip, result, error in zip(clips, results, errors):
+                self._finish(name, clip, result, error, elapsed)
+
+    def _finish(self, name: str, clip: str, result: bool, error: str, elapsed: float) -> None:
+        self.latency.setdefault(clip, {})[name] = elapsed
+
+        if not result:
+            if name == 'upload' and not self.store.get(clip)['notified']:
+                # 通知を先に送る(上流に戻るキューもあるので、詰まっていたらリトライのループに任せる)
+                self.store.defer(clip, 'notify', error)
+                logger.error(f'Pipeline stage {name} failed for {clip}: {error} (notify first, then retry)')
+                self._enqueue(self.store.get(clip))
+                return
+            delay = self.store.fail(clip, error)
+            logger.error(f'Pipeline stage {name} failed for {clip}: {error} (retry in {delay:.0f}s)')
+            return
+
+        logger.info(f'Pipeline stage {name} finished in {elapsed:.2f}s: {clip}')
+        next_stage = self.store.advance(clip)
+        if next_stage in self.queues and self.store.get(clip)['status'] == 'failed':
+            # 後回しにしたアップロードは、リトライのループに任せる
+            logger.info(f'Pipeline stage {next_stage} will be retried: {clip}')
+        elif next_stage in self.queues:
+            # 終了中は、空くのを待たずにやめる(queuedのまま残るので、次回の起動時に再開する)
+            while self.is_running:
+                try:
+                    self.queues[next_stage].put(clip, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+        else:
+            latency = self.latency.pop(clip, {})
+            logger.info(f'Pipeline finished: {clip} ({", ".join(f"{k}: {v:.2f}s" for k, v in latency.items())})')
+            for callback in self.callbacks:
+                callback(clip)
+
+    def _compress(self, job) -> bool:
+        # ffmpegで直接エンコードしていれば不要
+        if not job['is_encoded']:
+            ffmpeg = Ffmpeg()
+            video_file_path = ffmpeg.compress(Path(job['path']), env.FFMPEG_OPTIONS)
+            self.store.update(job['clip'], path=str(video_file_path), is_encoded=1)
+        return True
+
+    def _upload(self, job) -> bool:
+        # SFTPでアップロード
+        video_file_path = Path(job['path'])
+        ssh = self.ssh
+        logger.info(f'SSH to {env.SSH_HOSTNAME}({ssh.config["hostname"]})')
+        self.store.update(job['clip'], hostname=ssh.config['hostname'])
+        # NASに動画をSFTPでアップロード
+        return ssh.sftp_upload(
+            str(video_file_path),
+            str(Path(env.SSH_UPLOAD_DIR).joinpath(video_file_path.name)),
+        )
+
+    def _notify(self, jobs: list) -> list[bool]:
+        # 添付の数とサイズの上限に収まるだけ、1つのメッセージにまとめる
+        videos = {job['path']: job for job in jobs}
+        results = {}
+        for batch in self.disco.pack([Path(job['path']) for job in jobs]):
+            batch_jobs = [videos[str(video)] for video in batch]
+            uploaded_file_paths = '\n'.join(
+                f'//{job["hostname"]}{Path(env.SSH_UPLOAD_DIR).joinpath(Path(job["path"]).name)}' if job['uploaded']
+                else f'{Path(job["path"]).name}(NASへのアップロードに失敗しました。あとでリトライします)'
+                for job in batch_jobs
+            )
+            # 1つのまとまりの失敗で、他のまとまり(送信済みのものも含む)を失敗扱いにしない
+            try:
+                post_result, post_message = self.disco.post(
+                    f'{env.DETECT_LABEL}を動体検知しました\n{uploaded_file_paths}',
+                    batch,
+                    mention_id=env.MENTION_ID,
+                )
+            except Exception as e:
+                post_result, post_message = False, str(e)
+                logger.error(f'Failed to post {[job["clip"] for job in batch_jobs]}: {e}')
+            if not post_result and any(job['attempts'] == 0 for job in batch_jobs):
+                # 失敗の通知はリトライのたびには送らない
+                self.disco.post(
+                    f'動画のPOSTに失敗しました。\n{post_message}\n'
+                )
+            if len(batch) > 1:
+                logger.info(f'Posted {len(batch)} videos in one message: {post_result}')
+            for job in batch_jobs:
+                results[job['clip']] = post_result
+        return [results[job['clip']] for job in jobs]
+
+    def _cleanup(self, job) -> bool:
+        # アップロードが成功したら古いファイルは削除
+        self.ssh.remove_old_files(env.SSH_UPLOAD_DIR, env.THRESHOLD_STORAGE_DAYS, env.SWEEP_INTERVAL_SECONDS)
+
+        # Discordに通知できた映像は削除する
+        Path(job['path']).unlink(missing_ok=True)
+        logger.info(f'Delete videos: {[job["path"]]}')
+        return True
@@ -0,0 +1,224 @@
+import time
+import queue
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+from logging import getLogger
+
+import cv2
+import numpy as np
+
+from camenashi_kun.ffmpeg import FfmpegWriter, Segmenter
+
+
+logger = getLogger(__name__)
+
+
+class PreRoll:
+    '''
+    録画開始前の直近seconds秒分のフレームを、JPEGに圧縮してメモリに持っておく
+    max_bytesを超えたら古いものから捨てる
+    '''
+    def __init__(self, seconds: float, max_bytes: int, quality: int = 90) -> None:
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.frames = deque()  # (時刻, JPEGのバイト列)
+        self.nbytes = 0
+
+    def append(self, frame: np.ndarray) -> None:
+        success, jpeg = cv2.imencode('.jpg', frame, self.params)
+        if not success:
+            return
+        now = time.monotonic()
+        self.frames.append((now, jpeg))
+        self.nbytes += jpeg.nbytes
+
+        # 古いフレームと、メモリ上限を超えた分を捨てる
+        while self.frames and (now - self.frames[0][0] > self.seconds or self.nbytes > self.max_bytes):
+            _, old = self.frames.popleft()
+            self.nbytes -= old.nbytes
+
+    def flush(self):
+        # 古い順にデコードして返し、空にする
+        if self.frames:
+            logger.info(f'Pre-roll: {len(self.frames)} frames, {self.frames[-1][0] - self.frames[0][0]:.1f} seconds, '
+                        f'{self.nbytes / 10**6:.1f} MB')
+        while self.frames:
+            _, jpeg = self.frames.popleft()
+            self.nbytes -= jpeg.nbytes
+            yield cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+
+
+class Recorder:
+    '''
+    cv2.VideoWriterを専用スレッドで動かして、推論ループはフレームをキューに入れるだけにする
+    キューが一杯のときは、policyが'drop'ならフレームを捨て、'block'なら空くまで待つ
+    pre_rollがあれば、録画していない間のフレームはそちらに溜めて、録画開始時に先頭に書き出す
+    encoderが'ffmpeg'なら、ffmpegにフレームを流し込んでffmpeg_optionsで直接エンコードする
+    '''
+    def __init__(self, maxsize: int = 300, policy: str = 'drop', pre_roll: PreRoll = None,
+                 encoder: str = 'opencv', ffmpeg_options: list = None) -> None:
+        self.policy = policy
+        self.pre_roll = pre_roll
+        self.encoder = encoder
+        self.ffmpeg_options = ffmpeg_options or []
+        self.is_encoded = False  # 録画したファイルがffmpeg_optionsでエンコード済みか
+        self.queue = queue.Queue()
+        # 制御コマンドはキューの上限に関係なく入れたいので、フレーム数はセマフォで制限する
+        self.slots = threading.BoundedSemaphore(maxsize)
+        self.is_recording = False
+        self.written = 0  # 書き出したフレーム数
+        self.dropped = 0  # キューが一杯で捨てたフレーム数
+        self.max_depth = 0  # 録画中のキューの最大長
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def start(self, video_file_path: Path, fourcc: int, fps: float, size: tuple) -> None:
+        self.written, self.dropped, self.max_depth = 0, 0, 0
+        self.queue.put(('start', (video_file_path, fourcc, fps, size)))
+        self.is_recording = True
+
+    def write(self, frame: np.ndarray) -> None:
+        # 録画中でもpre-rollもなければ何もしない
+        if not self.is_recording and self.pre_roll is None:
+            return
+        # 録画していないときは、推論ループを止めないように常に捨てる
+        if not self.slots.acquire(blocking=self.is_recording and self.policy == 'block'):
+            self.dropped += 1
+            return
+        self.queue.put(('frame', frame))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def stop(self, callback=None) -> threading.Event:
+        '''
+        書き出しの完了を待たずに返る
+        完了したらcallback(video_file_path)を録画スレッドで呼び、戻り値のEventを立てる
+        '''
+        self.is_recording = False
+        done = threading.Event()
+        self.queue.put(('stop', (callback, done)))
+        return done
+
+    def close(self) -> None:
+        self.is_recording = False
+        self.queue.put(('close', None))
+        self.thread.join(timeout=10)
+
+    def _open_writer(self, video_file_path: Path, fourcc: int, fps: float, size: tuple):
+        if self.encoder == 'ffmpeg':
+            try:
+                self.is_encoded = True
+                return FfmpegWriter(video_file_path, fps, size, self.ffmpeg_options)
+            except OSError as e:
+                # ffmpegが起動できなければ、従来通り書き出してから圧縮する
+                logger.error(f'Failed to start ffmpeg encoder, fall back to cv2.VideoWriter: {e}')
+        self.is_encoded = False
+        return cv2.VideoWriter(str(video_file_path), fourcc, fps, size)
+
+    def _run(self) -> None:
+        video_writer = None
+        video_file_path = None
+        while True:
+            command, value = self.queue.get()
+            if command == 'frame':
+                if video_writer is not None:
+                    video_writer.write(value)
+                    self.written += 1
+                elif self.pre_roll is not None:
+                    self.pre_roll.append(value)
+                self.slots.release()
+            elif command == 'start':
+                video_file_path, fourcc, fps, size = value
+                video_writer = self._open_writer(video_file_path, fourcc, fps, size)
+                logger.info(f'Recorder started: {video_file_path.name} ({size[0]}x{size[1]} at {fps:g} FPS)')
+                # 録画開始前の数秒を先に書き出す
+                if self.pre_roll is not None:
+                    for frame in self.pre_roll.flush():
+                        if frame is not None and frame.shape[1::-1] == tuple(size):
+                            video_writer.write(frame)
+                            self.written += 1
+            elif command == 'stop':
+                callback, done = value
+                if video_writer is not None:
+                    if video_writer.release() is False:
+                        self.is_encoded = False  # ffmpegが失敗したら、圧縮からやり直してもらう
+                    video_writer = None
+                    logger.info(f'Recorder finished: {self.written} frames written, {self.dropped} dropped, '
+                                f'max queue depth {self.max_depth}')
+                    if callback is not None:
+                        try:
+                            callback(video_file_path)
+                        except Exception as e:
+                            logger.error(f'Recorder callback failed: {e}')
+                done.set()
+            elif command == 'close':
+                if video_writer is not None:
+                    video_writer.release()
+                break
+
+
+class SegmentRecorder:
+    '''
+    Recorderと同じインターフェースで、Segmenterのセグメントから録画を切り出す
+    フレームはエンコードしないので、writeは何もしない
+    '''
+    def __init__(self, segmenter: Segmenter, pre_roll_seconds: float = 0, speed: int = 1,
+                 ffmpeg_options: list = None) -> None:
+        self.segmenter = segmenter
+        self.pre_roll_seconds = pre_roll_seconds
+        self.speed = speed
+        self.ffmpeg_options = ffmpeg_options or []
+        self.is_recording = False
+        self.is_encoded = True  # 切り出した時点で完成しているので、圧縮は不要
+        self.started_at = None
+        self.video_file_path = None
+        self.segmenter.start()
+
+    @property
+    def depth(self) -> int:
+        return 0
+
+    def start(self, video_file_path: Path, fourcc: int, fps: float, size: tuple) -> None:
+        # セグメントはずっと撮りためているので、pre-roll分さかのぼって開始時刻とする
+        self.started_at = datetime.now() - timedelta(seconds=self.pre_roll_seconds)
+        self.segmenter.hold_from = self.started_at
+        self.video_file_path = video_file_path
+        self.is_recording = True
+        logger.info(f'Recorder started: {video_file_path.name} (stream copy from {self.started_at:%H:%M:%S})')
+
+    def write(self, frame: np.ndarray) -> None:
+        pass
+
+    def stop(self, callback=None) -> threading.Event:
+        '''
+        切り出しはセグメントが書き終わるのを待つので、別スレッドで行う
+        完了したらcallback(video_file_path)を呼び、戻り値のEventを立てる
+        '''
+        self.is_recording = False
+        done = threading.Event()
+        started_at, ended_at, video_file_path = self.started_at, datetime.now(), self.video_file_path
+
+        def cut() -> None:
+            if self.segmenter.cut(started_at, ended_at, video_file_path, self.speed, self.ffmpeg_options):
+                if callback is not None:
+                    try:
+                        callback(video_file_path)
+                    except Exception as e:
+                        logger.error(f'Recorder callback failed: {e}')
+            # 切り出したら、古いセグメントは消してよい
+            if not self.is_recording:
+                self.segmenter.hold_from = None
+            done.set()
+
+        threading.Thread(target=cut, daemon=True).start()
+        return done
+
+    def close(self) -> None:
+        self.is_recording = False
+        self.segmenter.stop()
@@ -0,0 +1,49 @@
+import time
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class InferenceScheduler:
+    '''
+    待機中はidle_fpsの低いレートで推論し、検知中(非検知の猶予秒数を含む)や動きがあるときは全フレーム推論する
+    推論しないフレームも録画用にはそのまま流れる
+    '''
+    def __init__(self, idle_fps: float = 1.0, motion_gate=None, report_seconds: float = 600) -> None:
+        self.interval = 1 / idle_fps
+        self.motion_gate = motion_gate
+        self.report_seconds = report_seconds
+        self.is_active = False  # 検知中かどうか(core.mainから更新する)
+
+        self.inferred = 0  # 推論したフレーム数
+        self.skipped = 0  # 推論しなかったフレーム数
+        self.last_inferred = 0.0
+        self.last_report = time.perf_counter()
+
+    def set_active(self, is_active: bool) -> None:
+        if is_active != self.is_active:
+            logger.info(f'Inference rate: {"full" if is_active else f"idle ({1 / self.interval:g} fps)"}')
+        self.is_active = is_active
+
+    def __call__(self, frames: list) -> bool:
+        now = time.perf_counter()
+        # 背景を更新し続けるため、検知中でも動き判定はする
+        motion = self.motion_gate(frames) if self.motion_gate is not None else False
+        if self.is_active or motion or now - self.last_inferred >= self.interval:
+            self.inferred += 1
+            self.last_inferred = now
+            result = True
+        else:
+            self.skipped += 1
+            result = False
+
+        if now - self.last_report > self.report_seconds:
+            self.report()
+            self.last_report = now
+        return result
+
+    def report(self) -> None:
+        total = self.inferred + self.skipped
+        rate = self.skipped / total if total else 0
+        logger.info(f'Scheduler: inferred {self.inferred}, skipped {self.skipped} ({rate:.1%} of frames skipped)')
@@ -1,6 +1,14 @@
+import time
+import shlex
+import socket
+import sqlite3
+import hashlib
+import threading
 import datetime as dt
 from datetime import datetime
 from pathlib import Path
+from functools import lru_cache
+from contextlib import contextmanager
 from logging import getLogger
 
 import paramiko
@@ -9,85 +17,379 @@ import paramiko
 logger = getLogger(__name__)
 
 
-class Ssh:
-    def __init__(self, hostname: str) -> None:
-        ssh_config = paramiko.SSHConfig()
-        config_file_path = str(Path.home().joinpath('.ssh', 'config'))
+@lru_cache(maxsize=None)
+def load_ssh_config() -> paramiko.SSHConfig:
+    # ~/.ssh/configのパースは1回だけ
+    ssh_config = paramiko.SSHConfig()
+    config_file_path = str(Path.home().joinpath('.ssh', 'config'))
+
+    with open(config_file_path, 'r') as f:
+        ssh_config.parse(f)
+    return ssh_config
+
+
+def file_checksum(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    '''
+    NASにアップロードしたファイルの一覧を、ローカルのSQLiteに持っておく
+    保存期間の判定やアップロード済みかの判定は、NASに問い合わせずにここを引く
+    NASの中身とのずれは、reconcileでたまに直す
+    '''
+    def __init__(self, db_path: Path) -> None:
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS uploads (
+                    remote_path TEXT PRIMARY KEY,
+                    remote_dir TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    checksum TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_uploads_dir_mtime ON uploads (remote_dir, mtime);
+                CREATE TABLE IF NOT EXISTS reconciled (
+                    remote_dir TEXT PRIMARY KEY,
+                    reconciled_at REAL NOT NULL
+                );
+            ''')
+
+    def get(self, remote_path: str) -> sqlite3.Row:
+        with self.lock:
+            return self.connection.execute('SELECT * FROM uploads WHERE remote_path = ?', (remote_path,)).fetchone()
+
+    def add(self, remote_path: str, size: int, mtime: float, checksum: str = None) -> None:
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO uploads (remote_path, remote_dir, size, mtime, checksum) VALUES (?, ?, ?, ?, ?)',
+                (remote_path, str(Path(remote_path).parent), size, mtime, checksum),
+            )
+
+    def remove(self, remote_paths: list[str]) -> None:
+        with self.lock:
+            self.connection.executemany('DELETE FROM uploads WHERE remote_path = ?', [(path,) for path in remote_paths])
+
+    def expired(self, remote_dir: str, threshold_timestamp: float) -> list[str]:
+        with self.lock:
+            return [row['remote_path'] for row in self.connection.execute(
+                'SELECT remote_path FROM uploads WHERE remote_dir = ? AND mtime < ? ORDER BY mtime',
+                (remote_dir, threshold_timestamp),
+            )]
+
+    def reconciled_at(self, remote_dir: str) -> float:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT reconciled_at FROM reconciled WHERE remote_dir = ?', (remote_dir,)
+            ).fetchone()
+        return row['reconciled_at'] if row is not None else 0.0
+
+    def reconcile(self, remote_dir: str, attrs: list[paramiko.SFTPAttributes]) -> None:
+        # NASにあるファイルで置き換える(サイズが変わっていなければ、チェックサムは引き継ぐ)
+        remote = {str(Path(remote_dir).joinpath(attr.filename)): attr for attr in attrs}
+        with self.lock:
+            known = {row['remote_path']: row for row in self.connection.execute(
+                'SELECT * FROM uploads WHERE remote_dir = ?', (remote_dir,)
+            )}
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'DELETE FROM uploads WHERE remote_path = ?', [(path,) for path in known.keys() - remote.keys()]
+            )
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO uploads (remote_path, remote_dir, size, mtime, checksum) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (path, remote_dir, attr.st_size, attr.st_mtime,
+                     known[path]['checksum'] if path in known and known[path]['size'] == attr.st_size else None)
+                    for path, attr in remote.items()
+                ],
+            )
+            self.connection.execute(
+                'INSERT OR REPLACE INTO reconciled (remote_dir, reconciled_at) VALUES (?, ?)', (remote_dir, time.time())
+            )
+            self.connection.execute('COMMIT')
+        logger.info(f'Manifest reconciled: {len(remote)} files in {remote_dir} '
+                    f'({len(known.keys() - remote.keys())} missing, {len(remote.keys() - known.keys())} unknown)')
 
-        with open(config_file_path, 'r') as f:
-            ssh_config.parse(f)
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
 
-        self.config = ssh_config.lookup(hostname)
+
+class Ssh:
+    '''
+    認証済みの接続(Transport)を1本張ったままにして、SFTPのチャネルはそこから開く
+    切れていたら使うときに再接続し(失敗が続いたら間隔を空ける)、しばらく使わなければ閉じる
+    manifestがあれば、アップロードしたファイルを記録して、重複アップロードや古いファイルの判定に使う
+    '''
+    def __init__(self, hostname: str, keepalive_seconds: int = 30, idle_seconds: float = 300,
+                 max_backoff_seconds: float = 300, manifest: Manifest = None,
+                 reconcile_seconds: float = 86400, connect_timeout: float = 15) -> None:
+        self.config = dict(load_ssh_config().lookup(hostname))
+        self.connect_timeout = connect_timeout  # 接続中はlockを持っているので、応答しないホストで止まらないように
         if 'port' not in self.config:
             self.config['port'] = 22
 
         logger.info(f'SSH config: {self.config}')
 
-    def sftp_upload(self, local: str, server: str) -> bool:
-        logger.info('Starting SFTP upload.')
+        self.keepalive_seconds = keepalive_seconds
+        self.idle_seconds = idle_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.client = None
+        self.lock = threading.Lock()
+        self.in_use = 0  # 使用中のチャネル数
+        self.last_used = time.monotonic()
+        self.backoff = 0.0
+        self.next_connect_at = 0.0
+        self.last_sweep_at = None  # 最後に古いファイルを掃除した時刻
+        self.manifest = manifest
+        self.reconcile_seconds = reconcile_seconds
+
+        self.reaper = threading.Thread(target=self._close_idle, daemon=True)
+        self.reaper.start()
+
+    def _is_alive(self) -> bool:
+        transport = self.client.get_transport() if self.client is not None else None
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except Exception:
+            return False
+
+    def _connect(self) -> paramiko.SSHClient:
+        # lockを取った状態で呼ぶこと
+        if self._is_alive():
+            return self.client
+        self._close()
+
+        now = time.monotonic()
+        if now < self.next_connect_at:
+            raise ConnectionError(f'Reconnecting to {self.config["hostname"]} in {self.next_connect_at - now:.0f} seconds.')
+
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.WarningPolicy())
         client.load_system_host_keys()
         try:
+            start = time.perf_counter()
             client.connect(
                 self.config['hostname'],
                 username=self.config['user'],
                 key_filename=self.config['identityfile'],
-                port=self.config['port']
+                port=self.config['port'],
+                timeout=self.connect_timeout,
+                banner_timeout=self.connect_timeout,
+                auth_timeout=self.connect_timeout,
             )
+        except Exception:
+            client.close()
+            # 失敗が続いたら、再接続までの間隔を倍々に伸ばす
+            self.backoff = min(max(1.0, self.backoff * 2), self.max_backoff_seconds)
+            self.next_connect_at = now + self.backoff
+            raise
+
+        client.get_transport().set_keepalive(self.keepalive_seconds)
+        # チャネルを開くたびの小さな要求がNagleで溜められて、サーバーの遅延ACKと合わせて40msほど待たされるので切る
+        client.get_transport().sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.client = client
+        self.backoff = 0.0
+        logger.info(f'SSH connected to {self.config["hostname"]} in {time.perf_counter() - start:.2f}s')
+        return client
+
+    @contextmanager
+    def _channel(self):
+        with self.lock:
+            client = self._connect()
+            self.in_use += 1
+        try:
+            yield client
+        finally:
+            with self.lock:
+                self.in_use -= 1
+                self.last_used = time.monotonic()
+
+    @contextmanager
+    def sftp(self):
+        with self._channel() as client:
             sftp_connection = client.open_sftp()
-            sftp_connection.put(local, server)
-            logger.info(f'SFTP uploaded: {server}')
-            return True
+            try:
+                yield sftp_connection
+            finally:
+                sftp_connection.close()
+
+    def exec_command(self, command: str) -> tuple[int, str, str]:
+        # (終了ステータス, 標準出力, 標準エラー出力)
+        with self._channel() as client:
+            _, stdout, stderr = client.exec_command(command)
+            output, error = stdout.read().decode(), stderr.read().decode()
+            return stdout.channel.recv_exit_status(), output, error
+
+    def _close_idle(self) -> None:
+        while True:
+            time.sleep(min(self.idle_seconds / 2, 30))
+            with self.lock:
+                if self.client is not None and self.in_use == 0 \
+                        and time.monotonic() - self.last_used > self.idle_seconds:
+                    logger.info(f'Close idle SSH connection to {self.config["hostname"]}')
+                    self._close()
+
+    def _close(self) -> None:
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def close(self) -> None:
+        with self.lock:
+            self._close()
+
+    def sftp_upload(self, local: str, server: str, retries: int = 3, chunk_size: int = 1024 * 1024,
+                    max_wait_seconds: float = 30) -> bool:
+        '''
+        一時ファイル(server.part)に書いてから、検証して本来の名前にリネームする
+        途中で切れたら、再接続できるまで待って(max_wait_seconds以内なら)、一時ファイルのサイズから続きを送る
+        '''
+        logger.info('Starting SFTP upload.')
+        try:
+            size = Path(local).stat().st_size
+            checksum = file_checksum(local)
+            if self.manifest is not None:
+                # 同じ中身がすでにNASにあれば、アップロードしない
+                uploaded = self.manifest.get(server)
+                if uploaded is not None and uploaded['checksum'] == checksum and uploaded['size'] == size:
+                    logger.info(f'Already uploaded, skip: {server}')
+                    return True
         except Exception as e:
             logger.error(e)
             return False
-        finally:
-            client.close()
 
-    def remove_old_files(self, target_dir: str, threshold_storage_days: int) -> None:
+        for attempt in range(retries):
+            try:
+                attr = self._upload(local, server, size, checksum, chunk_size)
+                if self.manifest is not None:
+                    self.manifest.add(server, attr.st_size, attr.st_mtime, checksum)
+                logger.info(f'SFTP uploaded: {server}')
+                return True
+            except Exception as e:
+                logger.error(f'SFTP upload failed ({attempt + 1}/{retries}): {e}')
+            if attempt + 1 < retries:
+                # 再接続の待ち時間が過ぎるまで待つ(長すぎるなら、呼び出し側のリトライに任せる)
+                wait = max(self.next_connect_at - time.monotonic(), 1.0)
+                if wait > max_wait_seconds:
+                    break
+                time.sleep(wait)
+        return False
+
+    def _upload(self, local: str, server: str, size: int, checksum: str, chunk_size: int) -> paramiko.SFTPAttributes:
+        part = f'{server}.part'
+        with self.sftp() as sftp_connection:
+            # 前回の一時ファイルが残っていれば、その続きから送る
+            try:
+                offset = sftp_connection.stat(part).st_size
+            except IOError:
+                offset = 0
+            if offset > size:
+                offset = 0
+            if offset > 0:
+                logger.info(f'Resume upload from {offset / 10**6:.1f} MB: {part}')
+
+            start = time.perf_counter()
+            with open(local, 'rb') as f, sftp_connection.open(part, 'r+b' if offset > 0 else 'wb') as remote:
+                # 書き込みの応答を待たずに次を送る
+                remote.set_pipelined(True)
+                f.seek(offset)
+                remote.seek(offset)
+                while chunk := f.read(chunk_size):
+                    remote.write(chunk)
+            elapsed = time.perf_counter() - start
+            logger.info(f'SFTP sent {(size - offset) / 10**6:.1f} MB in {elapsed:.2f}s '
+                        f'({(size - offset) / 10**6 / max(elapsed, 1e-6):.2f} MB/s)')
+
+            # サイズと(NAS側にsha256sumがあれば)ハッシュを確かめてから、本来の名前にする
+            uploaded_size = sftp_connection.stat(part).st_size
+            if uploaded_size != size:
+                sftp_connection.remove(part)
+                raise IOError(f'Size mismatch: {uploaded_size} bytes uploaded, expected {size} bytes')
+            status, output, _ = self.exec_command(f'sha256sum {shlex.quote(part)}')
+            if status != 0:
+                logger.warning('sha256sum is not available on the SSH server, verified by size only.')
+            elif not output.startswith(checksum):
+                sftp_connection.remove(part)
+                raise IOError(f'Checksum mismatch: {part}')
+
+            try:
+                sftp_connection.posix_rename(part, server)
+            except IOError:
+                # posix-renameに対応していないサーバーでは、消してからリネームする
+                try:
+                    sftp_connection.remove(server)
+                except IOError:
+                    pass
+                sftp_connection.rename(part, server)
+            return sftp_connection.stat(server)
+
+    def reconcile(self, target_dir: str, force: bool = False) -> None:
+        # ManifestをNASの中身に合わせる(reconcile_seconds以内に合わせていればNASには問い合わせない)
+        if not force and time.time() - self.manifest.reconciled_at(target_dir) < self.reconcile_seconds:
+            return
+        with self.sftp() as sftp_connection:
+            attrs = sftp_connection.listdir_attr(target_dir)
+        self.manifest.reconcile(target_dir, attrs)
+
+    def remove_old_files(self, target_dir: str, threshold_storage_days: int, interval: float = 0,
+                         chunk_size: int = 200) -> None:
+        # 前回の掃除からinterval秒経っていなければ何もしない
+        now = time.monotonic()
+        if self.last_sweep_at is not None and now - self.last_sweep_at < interval:
+            logger.info(f'Skip removing old files (next sweep in {interval - (now - self.last_sweep_at):.0f} seconds).')
+            return
         logger.info('Starting remove old files on SSH server.')
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        client.load_system_host_keys()
+        start = time.perf_counter()
 
         # 経過日数計算用
-        today = datetime.today()
-        threshold_timedelta = dt.timedelta(days=threshold_storage_days)
-        logger.info(f'Removing files older than {(today - dt.timedelta(days=threshold_storage_days)).date()}')
+        threshold_timestamp = (datetime.today() - dt.timedelta(days=threshold_storage_days)).timestamp()
+        logger.info(f'Removing files older than {datetime.fromtimestamp(threshold_timestamp).date()}')
 
         try:
-            client.connect(
-                self.config['hostname'],
-                username=self.config['user'],
-                key_filename=self.config['identityfile'],
-                port=self.config['port']
-            )
-            sftp_connection = client.open_sftp()
-
-            # dir内のファイルで、拡張子が.mp4のファイルのみリストにして返す
-            file_list = [file for file in sftp_connection.listdir(target_dir) if Path(file).suffix == '.mp4']
-            file_list.sort()
+            if self.manifest is not None:
+                # 保存期間を過ぎたファイルは、Manifestから引く
+                self.reconcile(target_dir)
+                removed_files = [
+                    file for file in self.manifest.expired(target_dir, threshold_timestamp) if Path(file).suffix == '.mp4'
+                ]
+            else:
+                with self.sftp() as sftp_connection:
+                    # 更新日時もまとめて取れるので、ファイルごとにstatしなくてよい
+                    attrs = sftp_connection.listdir_attr(target_dir)
 
-            sftp_connection.chdir(target_dir)
-            removed_files = []
-            for file_name in file_list:
-                # ファイル更新日時を取得して、保存期間を過ぎているか検証
-                file_date = datetime.fromtimestamp(sftp_connection.stat(file_name).st_mtime)
-                difference = today - file_date
+                # 拡張子が.mp4で、保存期間を過ぎたファイル
+                removed_files = sorted(
+                    str(Path(target_dir).joinpath(attr.filename)) for attr in attrs
+                    if Path(attr.filename).suffix == '.mp4' and attr.st_mtime < threshold_timestamp
+                )
 
-                # 保存期間を過ぎたら削除
-                if difference > threshold_timedelta:
-                    file_path = Path(target_dir).joinpath(file_name)
-                    removed_files.append(str(file_path))
-                    client.exec_command(f'rm {file_path}')
-                    logger.info(f'Remove file: {file_path}')
+            # rmは1コマンドでまとめて消す(引数が長くなりすぎないように分割)
+            for i in range(0, len(removed_files), chunk_size):
+                chunk = removed_files[i:i + chunk_size]
+                status, _, error = self.exec_command('rm -f -- ' + ' '.join(shlex.quote(file) for file in chunk))
+                if status != 0:
+                    logger.error(f'Failed to remove files (exit status {status}): {error}')
+                elif self.manifest is not None:
+                    self.manifest.remove(chunk)
 
+            self.last_sweep_at = now
+            elapsed = time.perf_counter() - start
             if len(removed_files) == 0:
-                logger.info('No files found to remove on the SSH server.')
+                logger.info(f'No files found to remove on the SSH server. ({elapsed:.2f}s)')
             else:
-                logger.info(f'Removed files: {removed_files}')
+                logger.info(f'Removed files: {removed_files} ({elapsed:.2f}s)')
         except Exception as e:
             logger.error(e)
-        finally:
-            client.close()
@@ -0,0 +1,118 @@
+import threading
+from pathlib import Path
+from logging import getLogger
+
+import cv2
+
+from camenashi_kun.recorder import Recorder
+
+
+logger = getLogger(__name__)
+
+
+class RecordStream:
+    '''
+    録画用に、カメラのメインストリーム(高解像度)を別スレッドで受信する
+    検知は低解像度のサブストリームで行い、録画だけこちらから取る
+    推論ループからの呼び出し(open, start_rec, stop_rec, close)は、接続や切断を待たずにすぐ返る
+    '''
+    def __init__(self, url: str, recorder: Recorder, max_backoff_seconds: float = 30) -> None:
+        self.url = url
+        self.recorder = recorder
+        self.max_backoff_seconds = max_backoff_seconds
+        self.fps = 0.0
+        self.size = (0, 0)
+        self.thread = None
+        self.stop = None  # 受信スレッドごとの停止フラグ(閉じた直後に開き直しても、古いスレッドは録画に書き込まない)
+        self.connected = threading.Event()  # 接続できて、解像度とFPSが取れたら立つ
+        self.lock = threading.Lock()
+        self.pending = None  # 接続前に頼まれた録画開始(video_file_path, fourcc, speed)
+
+    @property
+    def is_running(self) -> bool:
+        return self.stop is not None and not self.stop.is_set()
+
+    def open(self) -> None:
+        # 接続済みなら何もしない
+        if self.is_running:
+            return
+        logger.info('Open record stream.')
+        self.stop = threading.Event()
+        self.connected.clear()
+        # 接続に時間がかかるので、推論ループを止めないようにスレッド内で接続する
+        self.thread = threading.Thread(target=self._update, args=(self.stop,), daemon=True)
+        self.thread.start()
+
+    def _connect(self, stop: threading.Event):
+        # つながるまで、待ち時間を倍々に伸ばしながら接続し直す(接続を拒否されてもログを埋めない)
+        backoff = 1.0
+        while not stop.is_set():
+            cap = cv2.VideoCapture(self.url)
+            if cap.isOpened():
+                return cap
+            cap.release()
+            logger.warning(f'Record stream unavailable. Reconnecting in {backoff:.0f}s.')
+            stop.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff_seconds)
+        return None
+
+    def _update(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            cap = self._connect(stop)
+            if cap is None:
+                break
+            with self.lock:
+                if stop.is_set():  # つながる前に閉じられた
+                    cap.release()
+                    break
+                self.fps = max(cap.get(cv2.CAP_PROP_FPS) % 100, 0) or 15.0
+                self.size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                logger.info(f'Record stream connected: {self.size[0]}x{self.size[1]} at {self.fps:.2f} FPS')
+                self.connected.set()
+                # 接続前に録画開始を頼まれていたら、ここで始める
+                if self.pending is not None and not stop.is_set():
+                    self._start(*self.pending)
+                    self.pending = None
+
+            # 録画していないときも読み続けて、接続を温めておく(録画中でなければrecorderは何もしない)
+            while not stop.is_set():
+                success, frame = cap.read()
+                if not success:
+                    logger.warning('Record stream unresponsive. Reconnecting.')
+                    break
+                if not stop.is_set():
+                    self.recorder.write(frame)
+            cap.release()
+            stop.wait(1)  # 切れた直後は少し待ってからつなぎ直す
+
+    def _start(self, video_file_path: Path, fourcc: int, speed: int) -> None:
+        self.recorder.start(video_file_path, fourcc, self.fps * speed, self.size)
+
+    def start_rec(self, video_file_path: Path, fourcc: int, speed: int) -> None:
+        # まだつながっていなければ、つながったときに受信スレッドで録画を始める
+        with self.lock:
+            if self.connected.is_set():
+                self._start(video_file_path, fourcc, speed)
+            else:
+                logger.warning('Record stream is not connected yet. Recording starts when it connects.')
+                self.pending = (video_file_path, fourcc, speed)
+
+    def stop_rec(self, callback=None) -> bool:
+        # 最後までつながらず録画を始められなかったらFalse
+        with self.lock:
+            if self.pending is not None:
+                logger.error(f'Record stream did not connect, {self.pending[0].name} was not recorded.')
+                self.pending = None
+                return False
+        self.recorder.stop(callback=callback)
+        return True
+
+    def close(self, timeout: float = 0) -> None:
+        # 受信スレッドは、読みかけのフレームを読み終えたら止まる(timeoutを指定したらそれまで待つ)
+        if not self.is_running:
+            return
+        logger.info('Close record stream.')
+        self.stop.set()
+        self.connected.clear()
+        if timeout > 0:
+            self.thread.join(timeout=timeout)
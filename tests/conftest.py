@@ -0,0 +1,14 @@
+import os
+
+# camenashi_kunをimportするとEnvが読み込まれるので、.envがなくても必須の値だけは入れておく
+for key, value in {
+    'FFMPEG_OPTIONS': '-vcodec,libx264',
+    'MOVIE_SPEED': '1',
+    'NOTICE_THRESHOLD': '3',
+    'THRESHOLD_NO_DETECTED_SECONDS': '10',
+    'DETECT_AREA': '0,0,640,384',
+    'PAUSE_SECONDS': '5',
+    'BLACK_SCREEN_SECONDS': '60',
+    'THRESHOLD_STORAGE_DAYS': '30',
+}.items():
+    os.environ.setdefault(key, value)
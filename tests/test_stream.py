@@ -0,0 +1,126 @@
+"""
+デュアルストリーム録画(RecordStream)のテスト
+2つのローカルの動画ファイルを、カメラのstream2(検知用)とstream1(録画用)の代わりに使う
+
+Usage:
+    $ python -m pytest tests
+"""
+
+import sys
+import time
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+from camenashi_kun import stream as stream_module
+from camenashi_kun.recorder import Recorder
+from camenashi_kun.stream import RecordStream
+
+FOURCC = cv2.VideoWriter_fourcc(*'MJPG')
+SUB_SIZE, MAIN_SIZE = (320, 180), (640, 360)
+
+
+def make_video(path: Path, size: tuple, frames: int = 60, fps: float = 15) -> Path:
+    writer = cv2.VideoWriter(str(path), FOURCC, fps, size)
+    for i in range(frames):
+        writer.write(np.full((size[1], size[0], 3), i * 4 % 256, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def wait_until(condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def video_size(path: Path) -> tuple:
+    cap = cv2.VideoCapture(str(path))
+    size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return size
+
+
+@pytest.fixture
+def streams(tmp_path):
+    # stream2(低解像度)とstream1(高解像度)の代わり
+    return make_video(tmp_path / 'stream2.avi', SUB_SIZE), make_video(tmp_path / 'stream1.avi', MAIN_SIZE)
+
+
+@pytest.fixture
+def recorder():
+    recorder = Recorder()
+    yield recorder
+    recorder.close()
+
+
+def record(record_stream: RecordStream, recorder: Recorder, video_file_path: Path) -> Path:
+    assert wait_until(lambda: recorder.written > 0)
+    done = threading.Event()
+    assert record_stream.stop_rec(callback=lambda path: done.set())
+    assert done.wait(10)
+    return video_file_path
+
+
+def test_records_main_stream(streams, recorder, tmp_path):
+    sub, main = streams
+    assert video_size(sub) == SUB_SIZE  # 検知はサブストリームで行う
+
+    record_stream = RecordStream(str(main), recorder)
+    record_stream.open()  # 検知が始まったら、先につないでおく
+    assert record_stream.connected.wait(10)
+    try:
+        record_stream.start_rec(tmp_path / 'rec.avi', FOURCC, speed=1)
+        video_file_path = record(record_stream, recorder, tmp_path / 'rec.avi')
+    finally:
+        record_stream.close(timeout=5)
+    assert video_size(video_file_path) == MAIN_SIZE
+
+
+def test_start_before_connected(streams, recorder, tmp_path):
+    _, main = streams
+    record_stream = RecordStream(str(main), recorder)
+    # つながる前に録画を頼まれても、つながった時点で始まる
+    record_stream.start_rec(tmp_path / 'rec.avi', FOURCC, speed=1)
+    record_stream.open()
+    try:
+        video_file_path = record(record_stream, recorder, tmp_path / 'rec.avi')
+    finally:
+        record_stream.close(timeout=5)
+    assert video_size(video_file_path) == MAIN_SIZE
+
+
+def test_unreachable_main_stream(recorder, tmp_path, monkeypatch):
+    attempts = []
+    video_capture = cv2.VideoCapture
+
+    def counting_video_capture(*args):
+        attempts.append(time.monotonic())
+        return video_capture(*args)
+
+    monkeypatch.setattr(stream_module.cv2, 'VideoCapture', counting_video_capture)
+    record_stream = RecordStream(str(tmp_path / 'missing.avi'), recorder)
+    record_stream.open()
+    record_stream.start_rec(tmp_path / 'rec.avi', FOURCC, speed=1)
+    time.sleep(2.5)
+
+    # つながらなくても、間隔を空けて接続し直す(1s, 2s, ...)
+    assert 1 <= len(attempts) <= 3
+    # 録画できなかったことは、呼び出し側に返す
+    assert not record_stream.stop_rec()
+    assert recorder.written == 0
+
+    # 閉じるときに推論ループを待たせない
+    start = time.monotonic()
+    record_stream.close()
+    assert time.monotonic() - start < 0.5
@@ -29,7 +29,9 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
+from utils.augmentations import Preprocessor
 from utils.datasets import IMG_FORMATS, VID_FORMATS, LoadImages, LoadStreams
+from utils.engine import StageEngine
 from utils.general import (LOGGER, check_file, check_img_size, check_imshow, check_requirements, colorstr,
                            increment_path, non_max_suppression, print_args, scale_coords, strip_optimizer, xyxy2xywh)
 from utils.plots import Annotator, colors, save_one_box
@@ -63,6 +65,14 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         detect_area=None,
+        backend='opencv',  # stream decoder, opencv or ffmpeg
+        gate=None,  # callable(im0s) -> bool, skip inference on frames where it returns False
+        roi_margin=None,  # infer only on detect_area plus this margin (pixels), None for the full frame
+        threads=0,  # PyTorch/ONNX Runtime intra-op threads, 0 for the default
+        keep_classes=None,  # prune Detect() to these class names or ids (PyTorch weights), None to keep all
+        channels_last=False,  # PyTorch: channels_last memory format for the model and input tensor
+        pipelined=False,  # streams: run preprocess and inference in their own threads, overlapping with the caller
+        queue_size=1,  # pipelined: frames buffered between stages
         ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -76,11 +86,32 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
     save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
     # (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
+    # Threads
+    pipelined &= webcam
+    if pipelined:
+        # 前処理・後処理のスレッドの分だけ推論のスレッドを減らして、CPUを取り合わないようにする
+        threads = threads or max(1, os.cpu_count() - 2)
+        cv2.setNumThreads(1)  # 前処理のresizeは1スレッドで十分
+    if threads:
+        torch.set_num_threads(threads)
+
     # Load model
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn)
+    model = DetectMultiBackend(weights, device=device, dnn=dnn, threads=threads)
     stride, names, pt, jit, onnx, engine = model.stride, model.names, model.pt, model.jit, model.onnx, model.engine
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    if model.fixed_shape is not None and list(model.fixed_shape[2:]) != list(imgsz):
+        # --dynamicなしでexportしたモデルは、export時のサイズしか受け付けない
+        LOGGER.warning(f'WARNING: {weights} accepts only {list(model.fixed_shape[2:])}, ignoring --imgsz {imgsz}')
+        imgsz = list(model.fixed_shape[2:])
+
+    # 検知対象のクラスだけを出力するように、Detect()の出力層を削る
+    if keep_classes and pt and not jit:
+        ids = [names.index(c) if isinstance(c, str) else int(c) for c in keep_classes]
+        model.model.prune_classes(ids)
+        names = model.names = model.model.names
+        if classes is not None:  # 削った後のidに振り直す
+            classes = [ids.index(c) for c in classes if c in ids]
 
     # 検知エリアの座標
     x1, y1, x2, y2 = detect_area
@@ -89,41 +120,88 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
     half &= (pt or engine) and device.type != 'cpu'  # half precision only supported by PyTorch on CUDA
     if pt:
         model.model.half() if half else model.model.float()
+    channels_last &= pt and not jit
+    if channels_last:
+        model.model.to(memory_format=torch.channels_last)
 
     # Dataloader
     if webcam:
         # view_img = check_imshow()
         view_img = check_imshow() if view_img else False
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt and not jit)
+        roi = None if roi_margin is None else [x1 - roi_margin, y1 - roi_margin, x2 + roi_margin, y2 + roi_margin]
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt and not jit, backend=backend, roi=roi,
+                              raw=True, fixed=model.fixed_shape is not None)
+        imgsz = dataset.img_size  # ROIなら検知エリアに合わせて小さくなる(入力shape固定のモデルでは変わらない)
         bs = len(dataset)  # batch_size
+        # letterboxから正規化までを、使い回すテンソルへの書き込みだけで済ませる
+        # パイプラインでは、推論中・キュー内のフレームの分もバッファが要る
+        preprocess = Preprocessor(imgsz, stride=stride, auto=dataset.rect and dataset.auto, device=device, half=half,
+                                  channels_last=channels_last, buffers=queue_size + 2 if pipelined else 1)
+        dataset.quit_key = not pipelined  # パイプラインでは、qキーは表示している側で見る
     else:
         dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt and not jit)
         bs = 1  # batch_size
+        preprocess = None
     vid_path, vid_writer = [None] * bs, [None] * bs
 
     # Run inference
     model.warmup(imgsz=(1, 3, *imgsz), half=half)  # warmup
     dt, seen = [0.0, 0.0, 0.0], 0
-    for path, im, im0s, vid_cap, s in dataset:
+    fps = 0.0
+
+    def prepare(item):
+        # 推論しないフレーム(動きがないなど)は、imをNoneにして後段に流す
+        path, im, im0s, vid_cap, s = item
+        frame = dataset.count if webcam else getattr(dataset, 'frame', 0)
+        if pipelined:
+            im0s = [x.copy() for x in im0s]  # 次のフレームを読むとスロットが上書きされる
+        if gate is not None and not gate(im0s if webcam else [im0s]):
+            return path, None, im0s, vid_cap, s, frame, None, 0.0
+
         t1 = time_sync()
-        im = torch.from_numpy(im).to(device)
-        im = im.half() if half else im.float()  # uint8 to fp16/32
-        im /= 255  # 0 - 255 to 0.0 - 1.0
-        if len(im.shape) == 3:
-            im = im[None]  # expand for batch dim
-        t2 = time_sync()
-        dt[0] += t2 - t1
+        if preprocess is not None:
+            im = preprocess(im)
+        else:
+            im = torch.from_numpy(im).to(device)
+            im = im.half() if half else im.float()  # uint8 to fp16/32
+            im /= 255  # 0 - 255 to 0.0 - 1.0
+            if len(im.shape) == 3:
+                im = im[None]  # expand for batch dim
+        dt[0] += time_sync() - t1
+        return path, im, im0s, vid_cap, s, frame, None, 0.0
+
+    def infer(item):
+        path, im, im0s, vid_cap, s, frame, _, _ = item
+        if im is None:
+            return item
 
         # Inference
-        visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-        pred = model(im, augment=augment, visualize=visualize)
+        t2 = time_sync()
+        vis = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
+        pred = model(im, augment=augment, visualize=vis)
         t3 = time_sync()
         dt[1] += t3 - t2
 
-        # NMS
+        # NMS (推論と同じステージで行う。ONNX Runtimeの出力バッファは次の推論で上書きされるため)
         pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
         dt[2] += time_sync() - t3
+        return path, im, im0s, vid_cap, s, frame, pred, t3 - t2
+
+    if pipelined:
+        # 前処理(+デコード待ち) → 推論 → 後処理(この関数の呼び出し側)を重ねて動かす
+        pipe = StageEngine(dataset, [('preprocess', prepare), ('infer', infer)], maxsize=queue_size)
+        frames = pipe
+    else:
+        pipe = None
+        frames = (infer(prepare(item)) for item in dataset)
+
+    for path, im, im0s, vid_cap, s, frame, pred, t_infer in frames:
+        # 推論不要なフレームは、ラベルをNoneにしてそのまま返す
+        if im is None:
+            for im0 in (im0s if webcam else [im0s]):
+                yield None, im0.copy(), fps, f'{s}Skipped.'
+            continue
 
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
@@ -132,10 +210,10 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
         for i, det in enumerate(pred):  # per image
             seen += 1
             if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
+                p, im0 = path[i], im0s[i].copy()
                 s += f'{i}: '
             else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
+                p, im0 = path, im0s.copy()
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # im.jpg
@@ -150,7 +228,13 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
             detected_label = []
             if len(det):
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
+                if webcam and dataset.roi is not None:
+                    # ROIの座標に戻してから、フレーム全体の座標にずらす
+                    det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0[dataset.roi].shape).round()
+                    det[:, [0, 2]] += dataset.roi_offset[0]
+                    det[:, [1, 3]] += dataset.roi_offset[1]
+                else:
+                    det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
 
                 # Print results
                 for c in det[:, -1].unique():
@@ -183,7 +267,8 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
             im0 = annotator.result()
             if view_img:
                 cv2.imshow(str(p), im0)
-                cv2.waitKey(1)  # 1 millisecond
+                if cv2.waitKey(1) == ord('q') and pipe is not None:  # 1 millisecond
+                    pipe.close()  # q to quit
 
             # Save results (image with detections)
             # if save_img:
@@ -206,14 +291,16 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
 
             # たぶん画像1枚の秒数が「t3 - t2」になっている
             # なので下記の計算でFPSになるはず
-            fps = 1 / round(t3 - t2, 3)
+            fps = 1 / round(t_infer, 3)
             # 検知に必要な値を返す
-            yield detected_label, imc, fps, f'{s}Done. ({t3 - t2:.3f}s)'
-            # yield detected_label, im0, fps, f'{s}Done. ({t3 - t2:.3f}s)'
+            yield detected_label, imc, fps, f'{s}Done. ({t_infer:.3f}s)'
+            # yield detected_label, im0, fps, f'{s}Done. ({t_infer:.3f}s)'
 
     # Print results
     t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
     LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    if webcam:
+        dataset.report()
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
@@ -7,6 +7,7 @@ Format                  | Example                   | Export `include=(...)` arg
 PyTorch                 | yolov5s.pt                | -
 TorchScript             | yolov5s.torchscript.pt    | 'torchscript'
 ONNX                    | yolov5s.onnx              | 'onnx'
+ONNX INT8               | yolov5s-int8.onnx         | 'onnx_int8'
 CoreML                  | yolov5s.mlmodel           | 'coreml'
 TensorFlow SavedModel   | yolov5s_saved_model/      | 'saved_model'
 TensorFlow GraphDef     | yolov5s.pb                | 'pb'
@@ -21,6 +22,7 @@ Inference:
     $ python path/to/detect.py --weights yolov5s.pt
                                          yolov5s.torchscript.pt
                                          yolov5s.onnx
+                                         yolov5s-int8.onnx
                                          yolov5s.mlmodel  (under development)
                                          yolov5s_saved_model
                                          yolov5s.pb
@@ -36,12 +38,15 @@ TensorFlow.js:
 
 import argparse
 import json
+import math
 import os
 import subprocess
 import sys
 import time
 from pathlib import Path
 
+import cv2
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.mobile_optimizer import optimize_for_mobile
@@ -56,7 +61,7 @@ from models.common import Conv
 from models.experimental import attempt_load
 from models.yolo import Detect
 from utils.activations import SiLU
-from utils.datasets import LoadImages
+from utils.datasets import LoadImages, letterbox
 from utils.general import (LOGGER, check_dataset, check_img_size, check_requirements, colorstr, file_size, print_args,
                            url2file)
 from utils.torch_utils import select_device
@@ -99,6 +104,13 @@ def export_onnx(model, im, file, opset, train, dynamic, simplify, prefix=colorst
         # Checks
         model_onnx = onnx.load(f)  # load onnx model
         onnx.checker.check_model(model_onnx)  # check onnx model
+
+        # Metadata (read by DetectMultiBackend for ONNX Runtime inference)
+        d = {'stride': int(max(model.stride)), 'names': json.dumps(model.names)}
+        for k, v in d.items():
+            meta = model_onnx.metadata_props.add()
+            meta.key, meta.value = k, str(v)
+        onnx.save(model_onnx, f)
         # LOGGER.info(onnx.helper.printable_graph(model_onnx.graph))  # print
 
         # Simplify
@@ -122,6 +134,72 @@ def export_onnx(model, im, file, opset, train, dynamic, simplify, prefix=colorst
         LOGGER.info(f'{prefix} export failure: {e}')
 
 
+def video_calibration_frames(calib_dir, imgsz, stride, ncalib):
+    # Sample ncalib frames evenly across the recorded clips in calib_dir, preprocessed like detect.py (BCHW float 0-1)
+    videos = sorted(Path(calib_dir).glob('*.mp4'))
+    assert videos, f'no *.mp4 clips found in {calib_dir}'
+    per_video = math.ceil(ncalib / len(videos))
+    n = 0
+    for video in videos:
+        cap = cv2.VideoCapture(str(video))
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        for i in np.linspace(0, max(frames - 1, 0), per_video, dtype=int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(i))
+            success, img0 = cap.read()
+            if not success:
+                continue
+            img = letterbox(img0, imgsz, stride=stride, auto=False)[0]
+            img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+            yield np.ascontiguousarray(img, dtype=np.float32)[None] / 255
+            n += 1
+            if n >= ncalib:
+                cap.release()
+                return
+        cap.release()
+
+
+def export_onnx_int8(file, im, stride, calib_dir, ncalib, prefix=colorstr('ONNX INT8:')):
+    # YOLOv5 ONNX Runtime static INT8 quantization, calibrated on recorded clips
+    try:
+        check_requirements(('onnx', 'onnxruntime'))
+        import onnx
+        import onnxruntime
+        from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                              quantize_static)
+
+        LOGGER.info(f'\n{prefix} starting export with onnxruntime {onnxruntime.__version__}...')
+        f_fp32 = file.with_suffix('.onnx')
+        f = file.with_name(f'{file.stem}-int8.onnx')
+        assert f_fp32.exists(), f'{f_fp32} not found, export onnx first'
+
+        class Reader(CalibrationDataReader):
+            def __init__(self):
+                self.frames = video_calibration_frames(calib_dir, list(im.shape[2:]), stride, ncalib)
+
+            def get_next(self):
+                x = next(self.frames, None)
+                return None if x is None else {'images': x}
+
+        # Only Conv is quantized: the Detect decode (sigmoid, grid/anchor math) stays FP32 for box accuracy
+        quantize_static(str(f_fp32), str(f), Reader(),
+                        quant_format=QuantFormat.QDQ,
+                        op_types_to_quantize=['Conv'],
+                        per_channel=True,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+
+        # Keep stride/names metadata from the FP32 model
+        model_fp32, model_int8 = onnx.load(f_fp32), onnx.load(f)
+        if not model_int8.metadata_props:
+            model_int8.metadata_props.extend(model_fp32.metadata_props)
+            onnx.save(model_int8, f)
+        LOGGER.info(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
+        LOGGER.info(f"{prefix} validate with: 'python val.py --weights {f} --data data/cat.yaml --verbose'")
+    except Exception as e:
+        LOGGER.info(f'{prefix} export failure: {e}')
+
+
 def export_coreml(model, im, file, prefix=colorstr('CoreML:')):
     # YOLOv5 CoreML export
     ct_model = None
@@ -330,7 +408,10 @@ def run(data=ROOT / 'data/coco128.yaml',  # 'dataset.yaml path'
         topk_per_class=100,  # TF.js NMS: topk per class to keep
         topk_all=100,  # TF.js NMS: topk for all classes to keep
         iou_thres=0.45,  # TF.js NMS: IoU threshold
-        conf_thres=0.25  # TF.js NMS: confidence threshold
+        conf_thres=0.25,  # TF.js NMS: confidence threshold
+        calib_dir=ROOT.parent / 'camenashi_kun/videos',  # ONNX INT8: recorded clips for calibration
+        ncalib=200,  # ONNX INT8: number of calibration frames
+        keep_classes=None,  # prune Detect() to these class names or ids, i.e. ['cat']
         ):
     t = time.time()
     include = [x.lower() for x in include]
@@ -364,13 +445,26 @@ def run(data=ROOT / 'data/coco128.yaml',  # 'dataset.yaml path'
 
     for _ in range(2):
         y = model(im)  # dry runs
+
+    # Prune Detect() to the kept classes, outputs of the kept channels must be unchanged
+    if keep_classes:
+        ids = [names.index(c) if not str(c).isnumeric() else int(c) for c in keep_classes]
+        model.prune_classes(ids)
+        y_pruned = model(im)
+        keep = list(range(5)) + [5 + c for c in ids]
+        diff = (y_pruned[0] - y[0][..., keep]).abs().max()
+        assert torch.allclose(y_pruned[0], y[0][..., keep], rtol=1e-6, atol=1e-6), f'pruned outputs differ by {diff}'
+        LOGGER.info(f'Pruned Detect() outputs match the original model (max abs diff {diff:.3g})')
+        nc, names = model.nc, model.names
     LOGGER.info(f"\n{colorstr('PyTorch:')} starting from {file} ({file_size(file):.1f} MB)")
 
     # Exports
     if 'torchscript' in include:
         export_torchscript(model, im, file, optimize)
-    if 'onnx' in include:
+    if 'onnx' in include or 'onnx_int8' in include:
         export_onnx(model, im, file, opset, train, dynamic, simplify)
+    if 'onnx_int8' in include:
+        export_onnx_int8(file, im, gs, calib_dir, ncalib)
     if 'engine' in include:
         export_engine(model, im, file, train, half, simplify, workspace, verbose)
     if 'coreml' in include:
@@ -417,9 +511,14 @@ def parse_opt():
     parser.add_argument('--topk-all', type=int, default=100, help='TF.js NMS: topk for all classes to keep')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='TF.js NMS: IoU threshold')
     parser.add_argument('--conf-thres', type=float, default=0.25, help='TF.js NMS: confidence threshold')
+    parser.add_argument('--calib-dir', type=str, default=ROOT.parent / 'camenashi_kun/videos',
+                        help='ONNX INT8: recorded clips for calibration')
+    parser.add_argument('--ncalib', type=int, default=200, help='ONNX INT8: number of calibration frames')
+    parser.add_argument('--keep-classes', nargs='+', help='prune Detect() to these class names or ids, i.e. cat')
     parser.add_argument('--include', nargs='+',
                         default=['torchscript', 'onnx'],
-                        help='available formats are (torchscript, onnx, engine, coreml, saved_model, pb, tflite, tfjs)')
+                        help='available formats are (torchscript, onnx, onnx_int8, engine, coreml, saved_model, pb, '
+                             'tflite, tfjs)')
     opt = parser.parse_args()
     print_args(FILE.stem, opt)
     return opt
@@ -276,7 +276,7 @@ class Concat(nn.Module):
 
 class DetectMultiBackend(nn.Module):
     # YOLOv5 MultiBackend class for python inference on various backends
-    def __init__(self, weights='yolov5s.pt', device=None, dnn=True):
+    def __init__(self, weights='yolov5s.pt', device=None, dnn=True, threads=0):
         # Usage:
         #   PyTorch:      weights = *.pt
         #   TorchScript:            *.torchscript.pt
@@ -294,6 +294,7 @@ class DetectMultiBackend(nn.Module):
         pt, onnx, engine, tflite, pb, saved_model, coreml = (suffix == x for x in suffixes)  # backend booleans
         jit = pt and 'torchscript' in w.lower()
         stride, names = 64, [f'class{i}' for i in range(1000)]  # assign defaults
+        fixed_shape = None  # input shape(b,3,h,w) for static-shape exports, None if any size is accepted
 
         if jit:  # TorchScript
             LOGGER.info(f'Loading {w} for TorchScript inference...')
@@ -316,9 +317,35 @@ class DetectMultiBackend(nn.Module):
             net = cv2.dnn.readNetFromONNX(w)
         elif onnx:  # ONNX Runtime
             LOGGER.info(f'Loading {w} for ONNX Runtime inference...')
-            check_requirements(('onnx', 'onnxruntime-gpu' if torch.has_cuda else 'onnxruntime'))
-            import onnxruntime
-            session = onnxruntime.InferenceSession(w, None)
+            try:
+                import onnxruntime
+            except ImportError:
+                check_requirements(('onnx', 'onnxruntime-gpu' if torch.has_cuda else 'onnxruntime'))
+                import onnxruntime
+            cuda = torch.cuda.is_available() and 'CUDAExecutionProvider' in onnxruntime.get_available_providers()
+            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads  # 0 = ONNX Runtime default (physical cores)
+            options.inter_op_num_threads = 1  # YOLOv5 graph is sequential
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            # 最適化済みのモデルをキャッシュしておき、2回目以降はグラフの最適化を省く
+            cache = Path(w).with_suffix('.ort.onnx')
+            if cache.exists() and cache.stat().st_mtime >= Path(w).stat().st_mtime:
+                LOGGER.info(f'Loading optimized model from {cache}')
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+                session = onnxruntime.InferenceSession(str(cache), options, providers=providers)
+            else:
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                options.optimized_model_filepath = str(cache)
+                session = onnxruntime.InferenceSession(w, options, providers=providers)
+            meta = session.get_modelmeta().custom_metadata_map  # metadata written by export.py
+            if 'stride' in meta:
+                stride, names = int(meta['stride']), json.loads(meta['names'])
+            binding = session.io_binding()
+            ort_input, ort_output = session.get_inputs()[0], session.get_outputs()[0]
+            ort_buffers = {}  # preallocated (input, output) tensors by input shape
+            if all(isinstance(x, int) for x in ort_input.shape):  # exported without --dynamic
+                fixed_shape = tuple(ort_input.shape)
         elif engine:  # TensorRT
             LOGGER.info(f'Loading {w} for TensorRT inference...')
             import tensorrt as trt  # https://developer.nvidia.com/nvidia-tensorrt-download
@@ -336,6 +363,7 @@ class DetectMultiBackend(nn.Module):
             binding_addrs = {n: d.ptr for n, d in bindings.items()}
             context = model.create_execution_context()
             batch_size = bindings['images'].shape[0]
+            fixed_shape = tuple(bindings['images'].shape)
         else:  # TensorFlow model (TFLite, pb, saved_model)
             if pb:  # https://www.tensorflow.org/guide/migrate#a_graphpb_or_graphpbtxt
                 LOGGER.info(f'Loading {w} for TensorFlow *.pb inference...')
@@ -384,13 +412,15 @@ class DetectMultiBackend(nn.Module):
             box = xywh2xyxy(y['coordinates'] * [[w, h, w, h]])  # xyxy pixels
             conf, cls = y['confidence'].max(1), y['confidence'].argmax(1).astype(np.float)
             y = np.concatenate((box, conf.reshape(-1, 1), cls.reshape(-1, 1)), 1)
+        elif self.onnx and not self.dnn and im.device.type == 'cpu':  # ONNX Runtime with IO binding
+            y = self._ort_run(im)
         elif self.onnx:  # ONNX
             im = im.cpu().numpy()  # torch to numpy
             if self.dnn:  # ONNX OpenCV DNN
                 self.net.setInput(im)
                 y = self.net.forward()
             else:  # ONNX Runtime
-                y = self.session.run([self.session.get_outputs()[0].name], {self.session.get_inputs()[0].name: im})[0]
+                y = self.session.run([self.ort_output.name], {self.ort_input.name: im})[0]
         elif self.engine:  # TensorRT
             assert im.shape == self.bindings['images'].shape, (im.shape, self.bindings['images'].shape)
             self.binding_addrs['images'] = int(im.data_ptr())
@@ -421,6 +451,24 @@ class DetectMultiBackend(nn.Module):
         y = torch.tensor(y) if isinstance(y, np.ndarray) else y
         return (y, []) if val else y
 
+    def _ort_run(self, im):
+        # ONNX Runtime CPU inference, bound directly onto preallocated buffers (no per-call allocation)
+        shape = tuple(im.shape)
+        if shape not in self.ort_buffers:
+            # output shape from a single unbound run, then allocate once for this input shape
+            x = torch.zeros(shape, dtype=torch.float32)
+            out = self.session.run([self.ort_output.name], {self.ort_input.name: x.numpy()})[0]
+            self.ort_buffers[shape] = (x, torch.empty(out.shape, dtype=torch.float32))
+            LOGGER.info(f'ONNX Runtime buffers allocated: input {shape}, output {tuple(out.shape)}')
+        x, y = self.ort_buffers[shape]
+        if im.dtype != torch.float32 or not im.is_contiguous():
+            x.copy_(im)  # into the preallocated input
+            im = x
+        self.binding.bind_input(self.ort_input.name, 'cpu', 0, np.float32, shape, im.data_ptr())
+        self.binding.bind_output(self.ort_output.name, 'cpu', 0, np.float32, tuple(y.shape), y.data_ptr())
+        self.session.run_with_iobinding(self.binding)
+        return y
+
     def warmup(self, imgsz=(1, 3, 640, 640), half=False):
         # Warmup model by running inference once
         if self.pt or self.engine or self.onnx:  # warmup types
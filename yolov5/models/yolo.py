@@ -225,6 +225,21 @@ class Model(nn.Module):
         self.info()
         return self
 
+    def prune_classes(self, classes):  # keep only box, obj and the given class ids in Detect() output convs
+        m = self.model[-1]  # Detect()
+        keep = list(range(5)) + [5 + c for c in classes]  # channels to keep per anchor
+        for i, mi in enumerate(m.m):
+            idx = torch.tensor([a * m.no + k for a in range(m.na) for k in keep], device=mi.weight.device)
+            conv = nn.Conv2d(mi.in_channels, len(idx), mi.kernel_size, mi.stride).to(mi.weight.device)
+            conv.weight = nn.Parameter(mi.weight.detach()[idx].clone(), requires_grad=mi.weight.requires_grad)
+            conv.bias = nn.Parameter(mi.bias.detach()[idx].clone(), requires_grad=mi.bias.requires_grad)
+            m.m[i] = conv
+        m.nc, m.no = len(classes), len(classes) + 5
+        self.nc = self.yaml['nc'] = m.nc
+        self.names = [self.names[c] for c in classes]
+        LOGGER.info(f'Pruned Detect() to {m.nc} classes: {self.names}')
+        return self
+
     def info(self, verbose=False, img_size=640):  # print model information
         model_info(self, verbose, img_size)
 
@@ -0,0 +1,50 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Tests for Model.prune_classes(), as used by detect.py --keep-classes and export.py --keep-classes
+
+Usage:
+    $ cd yolov5 && python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from models.yolo import Model
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return Model(ROOT / 'models/yolov5s.yaml').eval()
+
+
+@pytest.mark.parametrize('fuse', [False, True])  # detect.py loads weights fused (attempt_load)
+@pytest.mark.parametrize('classes', [[15], [0, 15, 16]])
+@torch.no_grad()
+def test_prune_classes_keeps_outputs(model, fuse, classes):
+    if fuse:
+        model.fuse()
+    im = torch.rand(1, 3, 256, 320)
+    y = model(im)[0]
+    y_pruned = model.prune_classes(classes)(im)[0]
+    keep = list(range(5)) + [5 + c for c in classes]  # box, obj and kept classes
+    assert y_pruned.shape == (*y.shape[:2], len(keep))
+    assert torch.allclose(y_pruned, y[..., keep], rtol=1e-6, atol=1e-6)
+
+
+def test_prune_classes_metadata(model):
+    m = model.model[-1]  # Detect()
+    names = model.names
+    model.prune_classes([15, 0])
+    assert model.nc == model.yaml['nc'] == m.nc == 2
+    assert m.no == 7
+    assert model.names == [names[15], names[0]]
+    assert all(conv.out_channels == m.na * m.no for conv in m.m)
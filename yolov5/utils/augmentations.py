@@ -8,6 +8,7 @@ import random
 
 import cv2
 import numpy as np
+import torch
 
 from utils.general import LOGGER, check_version, colorstr, resample_segments, segment2box
 from utils.metrics import bbox_ioa
@@ -88,9 +89,8 @@ def replicate(im, labels):
     return im, labels
 
 
-def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
-    # Resize and pad image while meeting stride-multiple constraints
-    shape = im.shape[:2]  # current shape [height, width]
+def letterbox_geometry(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Returns letterbox resize/pad geometry for an image of `shape` [height, width]
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
 
@@ -113,14 +113,81 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
     dw /= 2  # divide padding into 2 sides
     dh /= 2
 
-    if shape[::-1] != new_unpad:  # resize
-        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return ratio, (dw, dh), new_unpad, (top, bottom, left, right)
+
+
+def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Resize and pad image while meeting stride-multiple constraints
+    shape = im.shape[:2]  # current shape [height, width]
+    ratio, (dw, dh), new_unpad, (top, bottom, left, right) = letterbox_geometry(shape, new_shape, auto, scaleFill,
+                                                                                scaleup, stride)
+
+    if shape[::-1] != new_unpad:  # resize
+        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
     im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return im, ratio, (dw, dh)
 
 
+class Preprocessor:
+    # Fused letterbox, BGR to RGB, HWC to CHW and 0-255 to 0.0-1.0 into one persistent BCHW tensor
+    def __init__(self, img_size=640, stride=32, auto=False, device='cpu', half=False, channels_last=False,
+                 color=114, buffers=1):
+        self.img_size = img_size
+        self.stride = stride
+        self.auto = auto
+        self.device = torch.device(device)
+        self.dtype = torch.half if half else torch.float
+        self.channels_last = channels_last
+        self.color = color
+        self.geometry = {}  # (index, shape) -> new_unpad, (top, left), out_shape, resize buffer
+        self.inputs = [None] * buffers  # persistent model inputs, used in turn (>1 when a consumer runs concurrently)
+        self.placed = [None] * buffers  # per input, the (w, h, top, left) each image was last written at
+        self.n = 0  # calls
+
+    def _geometry(self, i, shape):
+        if (i, shape) not in self.geometry:
+            _, _, new_unpad, (top, bottom, left, right) = letterbox_geometry(shape, self.img_size, auto=self.auto,
+                                                                             stride=self.stride)
+            out_shape = new_unpad[1] + top + bottom, new_unpad[0] + left + right
+            resized = None if shape[::-1] == new_unpad else np.empty((*new_unpad[::-1], 3), dtype=np.uint8)
+            self.geometry[i, shape] = new_unpad, (top, left), out_shape, resized
+        return self.geometry[i, shape]
+
+    def _alloc(self, shape):
+        # Padding is constant, so it is only written here and when an image moves within the input
+        im = torch.full(shape, self.color / 255, dtype=self.dtype, device=self.device)
+        return im.contiguous(memory_format=torch.channels_last) if self.channels_last else im
+
+    def __call__(self, ims):
+        # ims: list of BGR HWC uint8 images (views are fine), returns a persistent input shape(b,3,h,w)
+        geometry = [self._geometry(i, im.shape[:2]) for i, im in enumerate(ims)]
+        shapes = {g[2] for g in geometry}
+        assert len(shapes) == 1, 'Image shapes differ after letterbox'
+        shape = (len(ims), 3, *shapes.pop())
+        k = self.n % len(self.inputs)
+        self.n += 1
+        if self.inputs[k] is None or tuple(self.inputs[k].shape) != shape:
+            self.inputs[k], self.placed[k] = self._alloc(shape), [None] * len(ims)
+        input = self.inputs[k]
+        for i, (im, ((w, h), (top, left), _, resized)) in enumerate(zip(ims, geometry)):
+            if self.placed[k][i] != (w, h, top, left):
+                # Same output shape but a different source geometry (i.e. reconnect at another resolution):
+                # the previous image's pixels would otherwise stay in the new padding
+                if self.placed[k][i] is not None:
+                    input[i].fill_(self.color / 255)
+                self.placed[k][i] = (w, h, top, left)
+            if resized is not None:
+                im = cv2.resize(im, (w, h), dst=resized, interpolation=cv2.INTER_LINEAR)
+            src = torch.from_numpy(im).to(self.device, non_blocking=True)  # HWC uint8, no copy on CPU
+            dst = input[i, :, top:top + h, left:left + w]
+            for c in range(3):
+                dst[c].copy_(src[..., 2 - c])  # BGR to RGB and HWC to CHW, uint8 to float
+            dst.div_(255)  # 0 - 255 to 0.0 - 1.0
+        return input
+
+
 def random_perspective(im, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
                        border=(0, 0)):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(0.1, 0.1), scale=(0.9, 1.1), shear=(-10, 10))
@@ -9,11 +9,12 @@ import json
 import os
 import random
 import shutil
+import subprocess
 import time
 from itertools import repeat
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Thread
 from zipfile import ZipFile
 
 import cv2
@@ -25,9 +26,10 @@ from PIL import ExifTags, Image, ImageOps
 from torch.utils.data import DataLoader, Dataset, dataloader, distributed
 from tqdm import tqdm
 
-from utils.augmentations import Albumentations, augment_hsv, copy_paste, letterbox, mixup, random_perspective
-from utils.general import (LOGGER, check_dataset, check_requirements, check_yaml, clean_str, segments2boxes, xyn2xy,
-                           xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
+from utils.augmentations import (Albumentations, augment_hsv, copy_paste, letterbox, letterbox_geometry, mixup,
+                                 random_perspective)
+from utils.general import (LOGGER, check_dataset, check_requirements, check_yaml, clean_str, make_divisible,
+                           segments2boxes, xyn2xy, xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
 from utils.torch_utils import torch_distributed_zero_first
 
 # Parameters
@@ -280,12 +282,117 @@ class LoadWebcam:  # for inference
         return 0
 
 
+class FfmpegCapture:
+    # cv2.VideoCapture compatible decoder that runs ffmpeg in a subprocess
+    # ffmpegのscale/padフィルタでletterbox済みのサイズまで縮小・パディングし、
+    # stdoutに流れてくるrawvideo(bgr24)を、retrieveに渡されたバッファ(リングのスロット)に直接読み込む
+    def __init__(self, source, img_size=640, stride=32, auto=True, color=(114, 114, 114)):
+        self.img_size = img_size
+        self.stride = stride
+        self.auto = auto
+        self.color = '0x%02x%02x%02x' % tuple(color)
+        self.proc = None
+        self.grabbed = False
+        self.open(source)
+
+    @staticmethod
+    def _input_options(source):
+        # RTSPはUDPだとフレームが崩れやすいのでTCPで受ける
+        return ['-rtsp_transport', 'tcp'] if source.lower().startswith('rtsp://') else []
+
+    def _probe(self, source):
+        # ffprobeで元映像の解像度とFPSを取得する
+        command = ['ffprobe', '-v', 'error', *self._input_options(source), '-select_streams', 'v:0',
+                   '-show_entries', 'stream=width,height,avg_frame_rate', '-of', 'json', source]
+        stream = json.loads(subprocess.run(command, capture_output=True, text=True, timeout=30).stdout)['streams'][0]
+        num, _, den = stream.get('avg_frame_rate', '0/1').partition('/')
+        fps = float(num) / float(den) if float(den or 0) else 0.0
+        return int(stream['width']), int(stream['height']), fps
+
+    def open(self, source):
+        self.release()
+        self.source = source
+        try:
+            w, h, self.fps = self._probe(source)
+        except Exception as e:
+            LOGGER.warning(f'WARNING: ffprobe failed for {source}: {e}')
+            return False
+
+        # letterboxと同じ計算で、デコーダ内で縮小・パディングする
+        _, _, (nw, nh), (top, bottom, left, right) = letterbox_geometry((h, w), self.img_size, auto=self.auto,
+                                                                        stride=self.stride)
+        self.width, self.height = nw + left + right, nh + top + bottom
+        self.unpad = slice(top, top + nh), slice(left, left + nw)  # パディングを除いた領域
+        vf = f'scale={nw}:{nh},pad={self.width}:{self.height}:{left}:{top}:color={self.color}'
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', *self._input_options(source), '-i', source,
+                   '-an', '-vf', vf, '-pix_fmt', 'bgr24', '-f', 'rawvideo', 'pipe:1']
+        self.buffer = np.empty((self.height, self.width, 3), dtype=np.uint8)  # 読み捨て用(shapeの基準にもする)
+        self.proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        return True
+
+    def isOpened(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _readinto(self, image):
+        # 1フレーム分のバイト列をimageに読み込む
+        view, n = memoryview(image).cast('B'), 0
+        while n < len(view):
+            k = self.proc.stdout.readinto(view[n:])
+            if not k:  # EOF or ffmpeg died
+                return False
+            n += k
+        return True
+
+    def grab(self):
+        # 読み込みはretrieveで読み込み先に直接行う。retrieveされなかった前のフレームはここで読み捨てる
+        if self.proc is None:
+            self.grabbed = False
+            return False
+        if self.grabbed and not self._readinto(self.buffer):
+            self.grabbed = False
+            return False
+        self.grabbed = True
+        return True
+
+    def retrieve(self, image=None):
+        if not self.grabbed:
+            return False, image
+        self.grabbed = False
+        if image is None or image.shape != self.buffer.shape or image.dtype != np.uint8 or \
+                not image.flags.c_contiguous:
+            # 再接続で解像度が変わったときなどは、cv2.VideoCaptureと同じく新しい配列を返す
+            image = np.empty_like(self.buffer)
+        return self._readinto(image), image
+
+    def read(self, image=None):
+        return self.retrieve(image) if self.grab() else (False, image)
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FRAME_WIDTH: getattr(self, 'width', 0),
+                cv2.CAP_PROP_FRAME_HEIGHT: getattr(self, 'height', 0),
+                cv2.CAP_PROP_FPS: getattr(self, 'fps', 0.0)}.get(prop, 0)
+
+    def release(self):
+        self.grabbed = False
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+
 class LoadStreams:
     # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True):
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True, wait_fresh=True, timeout=1.0,
+                 backend='opencv', ring_size=4, roi=None, raw=False, fixed=False, report_seconds=600):
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.wait_fresh = wait_fresh  # 新しいフレームが届くまで待つ(同じフレームを二度推論しない)
+        self.timeout = timeout  # 新フレーム待ちのタイムアウト(秒)
+        self.quit_key = True  # __next__でqキーを見て終了する
+        self.fixed = fixed  # 入力shape固定のモデル用。ROIでも推論サイズを縮めず、切り出してからimg_sizeにletterboxする
+        self.raw = raw  # Trueならletterboxせず、推論に使う元画像(ROIの切り出し)をそのまま返す(Preprocessor用)
+        assert ring_size >= 3, 'ring_size must be >= 3 (write, published and held slots)'
 
         if os.path.isfile(sources):
             with open(sources) as f:
@@ -295,8 +402,16 @@ class LoadStreams:
 
         n = len(sources)
         self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
+        self.crops = [None] * n  # ffmpegでパディング済みの場合、元映像部分のスライス
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         self.auto = auto
+        self.seq, self.seen_seq = [0] * n, [0] * n  # フレーム通し番号(読込スレッド側, 推論側)
+        self.duplicates = 0  # 推論を回避した重複フレーム数
+        self.report_seconds = report_seconds  # 重複フレーム数をログに出す間隔
+        self.last_report = time.perf_counter()
+        self.cond = Condition()  # 新フレーム到着の通知用
+        # 事前確保したフレームのリングバッファ。読込スレッドは公開中・推論側が使用中以外のスロットに書き込む
+        self.ring, self.slot, self.held = [None] * n, [0] * n, [None] * n
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
@@ -305,25 +420,55 @@ class LoadStreams:
                 import pafy
                 s = pafy.new(s).getbest(preftype="mp4").url  # YouTube URL
             s = eval(s) if s.isnumeric() else s  # i.e. s = '0' local webcam
-            cap = cv2.VideoCapture(s)
+            if backend == 'ffmpeg' and isinstance(s, str):
+                cap = FfmpegCapture(s, img_size=self.img_size, stride=self.stride, auto=auto)
+                self.crops[i] = cap.unpad
+            else:
+                cap = cv2.VideoCapture(s)
             assert cap.isOpened(), f'{st}Failed to open {s}'
             w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             self.fps[i] = max(cap.get(cv2.CAP_PROP_FPS) % 100, 0) or 30.0  # 30 FPS fallback
             self.frames[i] = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0) or float('inf')  # infinite stream fallback
 
-            _, self.imgs[i] = cap.read()  # guarantee first frame
+            _, im = cap.read()  # guarantee first frame
+            self.ring[i] = [im] + [np.empty_like(im) for _ in range(ring_size - 1)]
+            self.imgs[i] = im
+            self.seq[i] = 1
             self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=True)
             LOGGER.info(f"{st} Success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)")
             self.threads[i].start()
         LOGGER.info('')  # newline
 
+        # ROI(検知エリア+余白)だけを推論する場合は、ROIが収まる最小のstrideの倍数を推論サイズにする
+        self.roi, self.roi_offset = None, (0, 0)
+        if roi is not None:
+            h0, w0 = self._view(0, self.imgs[0]).shape[:2]
+            x1, y1, x2, y2 = max(0, roi[0]), max(0, roi[1]), min(w0, roi[2]), min(h0, roi[3])
+            self.roi, self.roi_offset = (slice(y1, y2), slice(x1, x2)), (x1, y1)
+            if not self.fixed:
+                size = self.img_size if isinstance(self.img_size, (list, tuple)) else [self.img_size] * 2
+                self.img_size = [min(make_divisible(y2 - y1, stride), size[0]),
+                                 min(make_divisible(x2 - x1, stride), size[1])]
+            LOGGER.info(f'ROI inference: {x2 - x1}x{y2 - y1} at ({x1}, {y1}), img_size {self.img_size}')
+
         # check for common shapes
-        s = np.stack([letterbox(x, self.img_size, stride=self.stride, auto=self.auto)[0].shape for x in self.imgs])
+        s = np.stack([letterbox(self._source(i, x), self.img_size, stride=self.stride, auto=self.auto)[0].shape
+                      for i, x in enumerate(self.imgs)])
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         if not self.rect:
             LOGGER.warning('WARNING: Stream shapes differ. For optimal performance supply similarly-shaped streams.')
 
+    def report(self):
+        LOGGER.info(f'Duplicate frames skipped: {self.duplicates} (frames {self.count + 1})')
+
+    def _next_slot(self, i):
+        # 公開中(slot)でも推論側が使用中(held)でもない次のスロット
+        j = (self.slot[i] + 1) % len(self.ring[i])
+        while j in (self.slot[i], self.held[i]):
+            j = (j + 1) % len(self.ring[i])
+        return j
+
     def update(self, i, cap, stream):
         # Read stream `i` frames in daemon thread
         n, f, read = 0, self.frames[i], 1  # frame number, frame array, inference every 'read' frame
@@ -332,28 +477,76 @@ class LoadStreams:
             # _, self.imgs[index] = cap.read()
             cap.grab()
             if n % read == 0:
-                success, im = cap.retrieve()
-                if success:
-                    self.imgs[i] = im
-                else:
-                    LOGGER.warning('WARNING: Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] *= 0
+                with self.cond:
+                    j = self._next_slot(i)
+                slot = self.ring[i][j]
+                success, im = cap.retrieve(image=slot)  # スロットに直接デコード
+                if success and im is not slot:
+                    self.ring[i][j] = slot = im  # 解像度が変わった場合はスロットを作り直す
+                with self.cond:
+                    if not success:
+                        LOGGER.warning('WARNING: Video stream unresponsive, please check your IP camera connection.')
+                        slot[:] = 0
+                    # 真っ黒画面も新しいフレームとして通知する
+                    self.slot[i], self.imgs[i] = j, slot
+                    self.seq[i] += 1
+                    self.cond.notify_all()
+                if not success:
                     cap.open(stream)  # re-open stream if signal was lost
+                    if self.crops[i] is not None:
+                        self.crops[i] = cap.unpad  # 再接続で解像度が変わっているかもしれない
             time.sleep(1 / self.fps[i])  # wait time
 
     def __iter__(self):
         self.count = -1
         return self
 
+    def _is_fresh(self):
+        # 全ストリームで、前回返したフレームより新しいフレームが届いているか
+        return all(x > y for x, y in zip(self.seq, self.seen_seq))
+
+    def _view(self, i, im):
+        # パディングを除いた元映像
+        return im if self.crops[i] is None else im[self.crops[i]]
+
+    def _source(self, i, im):
+        # 推論に使う画像。ffmpegでletterbox済みならそのまま、ROIがあれば切り出す
+        if self.roi is None:
+            return im
+        return self._view(i, im)[self.roi]
+
     def __next__(self):
         self.count += 1
-        if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
+        if not all(x.is_alive() for x in self.threads) or (self.quit_key and cv2.waitKey(1) == ord('q')):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
 
+        with self.cond:
+            if self.wait_fresh and not self._is_fresh():
+                # 前回と同じフレームを返す代わりに、新しいフレームが届くまで待つ
+                self.duplicates += 1
+                while not self._is_fresh():
+                    if not self.cond.wait(self.timeout) and not all(x.is_alive() for x in self.threads):
+                        cv2.destroyAllWindows()
+                        raise StopIteration
+            self.seen_seq = self.seq.copy()
+            self.held = self.slot.copy()  # 次の__next__まで、このスロットは上書きされない
+            img0 = self.imgs.copy()
+
+        # 検知ループは終わらないので、終了時だけでなく定期的にも出す
+        now = time.perf_counter()
+        if now - self.last_report > self.report_seconds:
+            self.report()
+            self.last_report = now
+
+        src = [self._source(i, x) for i, x in enumerate(img0)]
+        if self.raw:
+            # 返したビューは次の__next__までスロットごと保持される
+            return self.sources, src, [self._view(i, x) for i, x in enumerate(img0)], None, ''
+
+        # 推論にはPreprocessor(raw=True)を使う。こちらは元のYOLOv5と同じnumpyのBCHWを返す
         # Letterbox
-        img0 = self.imgs.copy()
-        img = [letterbox(x, self.img_size, stride=self.stride, auto=self.rect and self.auto)[0] for x in img0]
+        img = [letterbox(x, self.img_size, stride=self.stride, auto=self.rect and self.auto)[0] for x in src]
 
         # Stack
         img = np.stack(img, 0)
@@ -362,7 +555,7 @@ class LoadStreams:
         img = img[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
         img = np.ascontiguousarray(img)
 
-        return self.sources, img, img0, None, ''
+        return self.sources, img, [self._view(i, x) for i, x in enumerate(img0)], None, ''
 
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
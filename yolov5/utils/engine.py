@@ -0,0 +1,100 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Pipelined inference engine
+"""
+
+import queue
+import time
+from threading import Event, Thread
+
+from utils.general import LOGGER
+
+_DONE = object()  # end of source marker
+
+
+class _Error:
+    # Exception raised in a stage thread, re-raised in the consumer
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class StageEngine:
+    # Runs source -> stages[0] -> ... -> stages[-1] with one thread per stage and bounded queues in between.
+    # Iterating yields the last stage's outputs in source order, so the consumer's own work overlaps with the stages.
+    def __init__(self, source, stages, maxsize=1, report_seconds=60):
+        self.source = source
+        self.names = [name for name, _ in stages]
+        self.queues = [queue.Queue(maxsize) for _ in stages]
+        self.busy = {name: 0.0 for name in self.names}  # seconds spent in each stage
+        self.count = {name: 0 for name in self.names}  # items processed by each stage
+        self.report_seconds = report_seconds
+        self.stop = Event()
+        self.threads = [Thread(target=self._run, args=(k, fn), name=f'engine-{name}', daemon=True)
+                        for k, (name, fn) in enumerate(stages)]
+        for thread in self.threads:
+            thread.start()
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _run(self, k, fn):
+        name, out = self.names[k], self.queues[k]
+        try:
+            source = iter(self.source) if k == 0 else None
+            while not self.stop.is_set():
+                item = next(source, _DONE) if k == 0 else self._get(self.queues[k - 1])
+                if item is _DONE or isinstance(item, _Error):
+                    self._put(out, item)  # pass the end (or upstream error) downstream
+                    return
+                t = time.perf_counter()
+                item = fn(item)
+                self.busy[name] += time.perf_counter() - t
+                self.count[name] += 1
+                if not self._put(out, item):
+                    return
+        except Exception as e:
+            self._put(out, _Error(e))
+
+    def __iter__(self):
+        start = last = time.perf_counter()
+        n = 0
+        try:
+            while True:
+                item = self._get(self.queues[-1])
+                if item is _DONE:
+                    break
+                if isinstance(item, _Error):
+                    raise item.exception
+                yield item
+                n += 1
+                now = time.perf_counter()
+                if now - last > self.report_seconds:
+                    self.report(n, now - start)
+                    last = now
+        finally:
+            self.close()
+            self.report(n, time.perf_counter() - start)
+
+    def report(self, n, elapsed):
+        latency = ', '.join(f'{name} {self.busy[name] / max(self.count[name], 1) * 1E3:.1f}ms' for name in self.names)
+        LOGGER.info(f'Engine: {n / max(elapsed, 1E-9):.1f} FPS ({n} frames), {latency}, '
+                    f'queues {[q.qsize() for q in self.queues]}')
+
+    def close(self, timeout=5):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join(timeout=timeout)